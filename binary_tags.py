@@ -0,0 +1,98 @@
+"""
+Columnar binary format for tag files, for training jobs that would otherwise json.load millions of correspondences.
+
+    magic     8 bytes   b"TAGSBIN1"
+    hdr_len   uint64    length of the header, padded so that the arrays below are 8-byte aligned
+    header    JSON      {"open_pair_name": str, "pairs": [pair names], "n_points": int}
+    offsets   int64     [n_pairs + 1], correspondences of pairs[i] are points[offsets[i]:offsets[i + 1]]
+    points    float64   [n_points, 2, 2], ((x0, y0), (x1, y1)) in original image pixels
+
+All numbers are little-endian. Points are kept as float64 so a JSON -> binary -> JSON round trip is lossless.
+"""
+from __future__ import annotations
+
+import json
+import struct
+import sys
+from array import array
+
+MAGIC = b"TAGSBIN1"
+BINARY_TAGS_EXT = ".tagsbin"
+
+
+def is_binary_tags_file(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _little_endian(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def write_binary_tags(path: str, payload: dict):
+    all_tags = payload.get("all_tags", {})
+    offsets = array("q", [0])
+    points = array("d")
+    for pair_points in all_tags.values():
+        for (x0, y0), (x1, y1) in pair_points:
+            points.extend((x0, y0, x1, y1))
+        offsets.append(len(points) // 4)
+
+    header = json.dumps({"open_pair_name": payload.get("open_pair_name", ""),
+                         "pairs": list(all_tags.keys()),
+                         "n_points": len(points) // 4}).encode()
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % 8)
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.write(_little_endian(offsets))
+        f.write(_little_endian(points))
+
+
+def load_binary_tags(path: str) -> tuple[dict, object, object]:
+    """
+    Fast loader for training jobs: returns the header, the pair offsets and the (n_points, 2, 2) points.
+    With numpy installed the arrays are read-only memory maps of the file, otherwise they are flat array.array's.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a {BINARY_TAGS_EXT} file")
+        header_len, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len))
+        data_start = f.tell()
+
+        n_pairs, n_points = len(header["pairs"]), header["n_points"]
+        try:
+            import numpy as np
+        except ImportError:
+            offsets = array("q")
+            offsets.frombytes(f.read(8 * (n_pairs + 1)))
+            points = array("d")
+            points.frombytes(f.read(8 * 4 * n_points))
+            if sys.byteorder == "big":
+                offsets.byteswap()
+                points.byteswap()
+            return header, offsets, points
+
+    offsets = np.memmap(path, dtype="<i8", mode="r", offset=data_start, shape=(n_pairs + 1,))
+    points = np.memmap(path, dtype="<f8", mode="r", offset=data_start + 8 * (n_pairs + 1), shape=(n_points, 2, 2))
+    return header, offsets, points
+
+
+def read_binary_tags(path: str) -> dict:
+    """ Import a binary tags file back into the payload layout of the JSON tags file. """
+    header, offsets, points = load_binary_tags(path)
+    flat = points.tolist() if isinstance(points, array) else points.reshape(-1).tolist()
+    offsets = offsets.tolist()
+
+    all_tags = {}
+    for idx, name in enumerate(header["pairs"]):
+        all_tags[name] = [[[flat[i], flat[i + 1]], [flat[i + 2], flat[i + 3]]]
+                          for i in range(4 * offsets[idx], 4 * offsets[idx + 1], 4)]
+
+    return {"open_pair_name": header["open_pair_name"], "timestamp": "", "all_tags": all_tags}
@@ -7,7 +7,9 @@ MAX_COLORS = 10
 IMG_SCALES = (0.3, 0.5, 0.7, 0.85, 1, 1.5, 2.1, 3, 4.5, 6.5, 9)
 NEUTRAL_ZOOM_IDX = IMG_SCALES.index(1)
 
-IMG_FILES = (".jpg", ".jpeg", ".png")
+IMG_FILES = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp")
+# Pillow refuses images over ~179 MP as decompression bombs, well below what a pyramidal TIFF scan holds
+MAX_IMAGE_PIXELS = 1_000_000_000
 
 TAG_LABEL_BG = "#c8c8d2"
 
@@ -19,4 +21,35 @@ PT_OUTLINE_WIDTH = 1
 
 INTERVAL_SAVE = 2000
 INTERVAL_POLL = 100
+INTERVAL_REFINE = 200  # idle time before the view is re-rendered with the fine filter
+INTERVAL_REFINE_POLL = 15
+INTERVAL_RESCAN = 3000  # how often the open folder is checked for new pairs
+INTERVAL_RESTORE = 50  # time for Tk to paint the session preview before the pair is loaded
+INTERVAL_DECODE_POLL = 10
+
+# Two-tier rendering, PIL filter names: the fast filter while interacting, the fine one to refine the view once idle
+RESAMPLE_FAST = "NEAREST"
+RESAMPLE_FINE = "LANCZOS"
+REFINE_CACHE_SIZE = 2  # original pages kept decoded by the refinement thread, one per canvas
+
+# Match suggestions: keypoints are detected on a copy capped to FEATURE_MAX_EDGE, in FEATURE_WORKERS processes
+FEATURE_MAX_EDGE = 1024
+FEATURE_COUNT = 1500
+FEATURE_SNAP_RADIUS = 12  # in working pixels, how far a click may be from the keypoint standing in for it
+FEATURE_MIN_SCORE = 0.8
+FEATURE_RATIO = 0.95
+FEATURE_WORKERS = 2
+FEATURE_LOOKAHEAD = 2  # pairs precomputed on each side of the current one
+# pairs kept, each is ~0.75 MB of keypoints and descriptors: the lookahead window plus a few just left behind
+FEATURE_CACHE_SIZE = 2 * FEATURE_LOOKAHEAD + 4
+
+DECODE_WORKERS = 2  # one per image of a pair, so both decode in parallel
+
+# QA overlay export: each pair is rendered side by side into OVERLAY_SIZE, pairs go to workers in chunks
+OVERLAY_SIZE = (1600, 800)
+OVERLAY_QUALITY = 85  # JPEG
+OVERLAY_CHUNK = 8
+
+SESSION_DIR = "~/.image_tagging_tool"  # last session snapshot, restored on launch
+
 PointsType = tuple[tuple[int, int], tuple[int, int]]
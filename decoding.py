@@ -0,0 +1,161 @@
+"""
+Image decoding in worker processes. The UI process reads only the image header and allocates one shared memory
+segment for the decoded image and one per zoom level it will display in full. A worker decodes and resizes into
+those segments, and the UI wraps them as PIL images without any pixel data being pickled or copied across.
+Pixels are stored as L, RGBA or RGBX, the layouts PIL can wrap around a foreign buffer without copying.
+"""
+from __future__ import annotations
+
+from multiprocessing.shared_memory import SharedMemory
+
+from constants import RESAMPLE_FAST
+from utils import Canvas, open_page, open_overviews, pick_overview, scaled_size
+
+SHARED_BANDS = {"L": 1, "RGBA": 4, "RGBX": 4}
+
+SharedImageType = tuple[str, tuple[int, int]]  # segment name, size
+
+
+def shared_mode(mode: str) -> str:
+    return mode if mode in SHARED_BANDS else "RGBX"
+
+
+def working_size(size: tuple[int, int], max_edge: int | None) -> tuple[int, int]:
+    width, height = size
+    if max_edge is None or max(width, height) <= max_edge:
+        return width, height
+
+    ratio = max_edge / max(width, height)
+    return max(1, round(width * ratio)), max(1, round(height * ratio))
+
+
+def _allocate(size: tuple[int, int], mode: str) -> SharedMemory:
+    width, height = size
+    return SharedMemory(create=True, size=max(1, width * height * SHARED_BANDS[mode]))
+
+
+def plan_decode(path: str, max_edge: int | None,
+                scales: tuple[float, ...]) -> tuple[bool, str | tuple[list[SharedMemory], dict]]:
+    """
+    Allocate shared memory for decoding path, capped to max_edge, and for every zoom level that fits in it.
+    The level at the cap itself, the neutral one without a cap, shares the decoded image's segment.
+    Returns the segments, owned by the caller until release_segments, and the picklable spec for decode_into.
+    """
+    from PIL import Image
+
+    try:
+        with open_page(path) as image:
+            source_size, mode = image.size, shared_mode(image.mode)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        return False, str(e)
+
+    base_size = working_size(source_size, max_edge)
+    base_scale = base_size[0] / source_size[0]
+    segments = [_allocate(base_size, mode)]
+    levels = []
+    for scale in scales:
+        if scaled_size(source_size, scale) == base_size:
+            levels.append((segments[0].name, base_size))
+        elif scale <= base_scale:
+            segments.append(_allocate(scaled_size(source_size, scale), mode))
+            levels.append((segments[-1].name, scaled_size(source_size, scale)))
+        else:
+            levels.append(None)
+
+    spec = {"mode": mode,
+            "source_size": source_size,
+            "source_scale": base_scale,
+            "base": (segments[0].name, base_size),
+            "levels": levels}
+    return True, (segments, spec)
+
+
+def _write(shared: SharedImageType, image):
+    name, size = shared
+    shm = SharedMemory(name=name)
+    data = image.tobytes()
+    shm.buf[:len(data)] = data
+    shm.close()
+
+
+def decode_into(path: str, spec: dict):
+    """
+    Worker side: write the decoded image and its levels to shared memory. Each comes from the coarsest embedded
+    resolution of path that holds it, and every page used is decoded once, reduced by a JPEG draft where it can be.
+    """
+    from PIL import Image
+
+    overviews = open_overviews(path)
+    source_w, _ = spec["source_size"]
+    targets = [spec["base"]] + [level for level in spec["levels"] if level is not None and level != spec["base"]]
+    pages = {}  # id of the page -> (page, the targets resized from it)
+    for target in targets:
+        _, size = target
+        page, _ = pick_overview(overviews, size[0] / source_w)
+        pages.setdefault(id(page), (page, []))[1].append(target)
+
+    for page, page_targets in pages.values():
+        page.draft(None, max(size for _, size in page_targets))
+        image = page.convert(spec["mode"])
+        for target in page_targets:
+            _, size = target
+            if image.size == size:
+                _write(target, image)
+            elif target == spec["base"]:
+                _write(target, image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0))
+            else:
+                _write(target, image.resize(size, Image.Resampling[RESAMPLE_FAST]))
+
+
+def wrap_shared(segment: SharedMemory, mode: str, size: tuple[int, int]):
+    """ A read-only PIL image over the segment's pixels, without copying them. """
+    from PIL import Image
+
+    return Image.frombuffer(mode, size, segment.buf, "raw", mode, 0, 1)
+
+
+def release_segments(segments: list[SharedMemory]) -> list[SharedMemory]:
+    """ Free the segments. Returns those still referenced by live images, to be released again later. """
+    busy = []
+    for segment in segments:
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+        try:
+            segment.close()
+        except BufferError:
+            busy.append(segment)
+
+    return busy
+
+
+def load_shared_images(canvas: Canvas, path: str, segments: list[SharedMemory], spec: dict) -> list[SharedMemory]:
+    """
+    Point the canvas at the images a worker decoded into segments.
+    Returns the segments the canvas no longer needs: its previous ones, and the zoom levels now copied into Tk.
+    """
+    from PIL import ImageTk
+
+    mode = spec["mode"]
+    _, base_size = spec["base"]
+    working = wrap_shared(segments[0], mode, base_size)
+    level_segments = iter(segments[1:])
+    pyramid = []
+    for level in spec["levels"]:
+        if level is None:
+            pyramid.append(None)
+        elif level == spec["base"]:
+            pyramid.append(ImageTk.PhotoImage(working))
+        else:
+            _, size = level
+            pyramid.append(ImageTk.PhotoImage(wrap_shared(next(level_segments), mode, size)))
+
+    released = canvas.shared + segments[1:]
+    canvas.shared = segments[:1]
+    canvas.path = path
+    canvas.working = working
+    canvas.source_size = spec["source_size"]
+    canvas.source_scale = spec["source_scale"]
+    canvas.scaled_images = tuple(pyramid)
+    return released
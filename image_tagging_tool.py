@@ -1,25 +1,55 @@
 from __future__ import annotations
 
+import importlib.util
 import json
+import multiprocessing
 import os
 import tkinter as tk
 import platform
+from collections import OrderedDict
+from collections.abc import Callable
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from tkinter import filedialog, messagebox, ttk
 
-from PIL import Image
-
 from constants import __VERSION__, MAX_COLORS, IMG_SCALES, IMG_FILES, \
-    INTERVAL_SAVE, INTERVAL_POLL, PointsType, PT_OUTLINE_WIDTH, NEUTRAL_ZOOM_IDX
-from utils import generate_rainbow_colors, generate_image_pyramid, put_image_on_canvas, get_canvas_position, \
-    apply_image_scaling, in_canvas_coords, in_image_coords, Canvas, reset_canvases, format_tag, make_pairs, \
-    read_tags_file, get_tag_name_convention, find_closest, get_centered_oval_bbox, get_display_dir, get_point_size
+    INTERVAL_SAVE, INTERVAL_POLL, PointsType, PT_OUTLINE_WIDTH, NEUTRAL_ZOOM_IDX, INTERVAL_REFINE, \
+    INTERVAL_REFINE_POLL, RESAMPLE_FINE, INTERVAL_RESTORE, INTERVAL_RESCAN, FEATURE_WORKERS, FEATURE_CACHE_SIZE, \
+    FEATURE_LOOKAHEAD, DECODE_WORKERS, INTERVAL_DECODE_POLL
+from utils import generate_rainbow_colors, get_canvas_position, apply_image_scaling, in_canvas_coords, \
+    in_image_coords, Canvas, reset_canvases, format_tag, make_pairs, read_tags_file, get_tag_name_convention, \
+    find_closest, get_centered_oval_bbox, get_display_dir, get_point_size, show_zoom_level, \
+    image_origin, refresh_region, get_visible_region, resample_region, put_refined_on_canvas, \
+    stat_image_files, collect_new_pairs, forget_decoded_pages, get_refine_job, get_start_zoom_idx
+from decoding import plan_decode, decode_into, load_shared_images, release_segments
+from session import read_session, write_session, ensure_session_dir, get_preview_path
+from shards import get_shard_tag_name, select_shard, acquire_tags_lock, release_tags_lock, in_shard_by_name
 
 
 class ImageTaggingTool:
-    def __init__(self, small_window: bool, tiny_window: bool):
+    def __init__(self, small_window: bool, tiny_window: bool, max_edge: int | None = None,
+                 annotator: str | None = None, shard: tuple[str, int, int] | None = None, trace_path: str | None = None,
+                 run: bool = True):
         self.debug = False
+        self.recorder = None  # input trace recording, see input_trace
+        if trace_path is not None:
+            from input_trace import TraceRecorder
+
+            # the handlers are wrapped before any widget binds them
+            self.recorder = TraceRecorder(trace_path)
+            self.recorder.install(self)
+        self.max_edge = max_edge  # working-resolution mode: cap on the decoded long edge, None decodes fully
+        self.annotator = annotator  # tags go to a per-annotator file instead of the canonical one
+        self.shard = shard  # only this part of each folder is opened, see shards.parse_shard_spec
         self._save_scheduler_id = None
         self._poll_scheduler_id = None
+        self._rescan_scheduler_id = None
+        self.refine_pool = ThreadPoolExecutor(max_workers=1)  # PIL releases the GIL while resampling
+        self.io_pool = ThreadPoolExecutor(max_workers=1)  # filesystem scans
+        self.feature_pool = None  # keypoint detection processes, started with the first pair
+        self.decode_pool = None  # image decoding processes, started with the first pair
+        self.decode_jobs = []  # (canvas, path, segments, spec, future) of the pair being decoded
+        self.busy_segments = []  # released shared memory still referenced by an image, retried on later loads
 
         self.root = tk.Tk()
         RES_W, RES_H = self.root.wm_maxsize()
@@ -51,11 +81,19 @@ class ImageTaggingTool:
         self.points: list[PointsType] = []
         self.all_tags: dict[str, list[PointsType]] = {}
         self.current_pair: str | None = None
+        self.shown_pair: str | None = None  # the pair on the canvases, current_pair once it is loaded
         self.image_pairs: list[tuple[str, str]] = []
         self.reverse_file_index: dict[str, int] = {}
         self.file_index: dict[int, str] = {}
         self.loading_done = False
         self.data_dir = None
+        self.tags_path = None
+        self.tags_lock = None
+        self.dir_mtime = None  # folder watcher state, see rescan
+        self.known_files: set[str] = set()
+        self.unsettled_files: dict[str, tuple[int, int]] = {}  # new files seen once, name -> (size, mtime)
+        self.pending_files: dict[str, str] = {}
+        self.features: OrderedDict[str, Future] = OrderedDict()  # pair name -> keypoints of both images, LRU
         self.suppress_select_event = False
         self.pan_start_x = 0
         self.pan_start_y = 0
@@ -180,8 +218,28 @@ class ImageTaggingTool:
 
         self.root.bind("<KeyPress-space>", self.confirm_tag)
         self.root.bind("<ButtonPress-1>", self.on_click)
-
-        self.root.mainloop()
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+
+        # run=False leaves the event loop to the caller, e.g. the soak harness
+        if run:
+            self.root.after_idle(self.restore_session)
+            self.root.mainloop()
+            self.shutdown()
+
+    def shutdown(self):
+        release_tags_lock(self.tags_lock)
+        if self.recorder is not None:
+            self.recorder.close()
+        self.refine_pool.shutdown(wait=False, cancel_futures=True)
+        self.io_pool.shutdown(wait=False, cancel_futures=True)
+        if self.feature_pool is not None:
+            self.feature_pool.shutdown(wait=False, cancel_futures=True)
+        self.cancel_decode()
+        if self.decode_pool is not None:
+            self.decode_pool.shutdown(wait=False, cancel_futures=True)
+        for canvas in (self.canvas0, self.canvas1):
+            canvas.working = None  # it wraps the shared memory
+            release_segments(canvas.shared)
 
     def reset(self):
         if self._save_scheduler_id is not None:
@@ -192,15 +250,31 @@ class ImageTaggingTool:
             self.root.after_cancel(self._poll_scheduler_id)
             self._poll_scheduler_id = None
 
+        if self._rescan_scheduler_id is not None:
+            self.root.after_cancel(self._rescan_scheduler_id)
+            self._rescan_scheduler_id = None
+
         self.tag_mode = True
         self.points = []
         self.all_tags = {}
         self.current_pair = None
+        self.shown_pair = None
         self.image_pairs = []
         self.reverse_file_index = {}
         self.file_index = {}
         self.loading_done = False
         self.data_dir = None
+        self.tags_path = None
+        release_tags_lock(self.tags_lock)
+        self.tags_lock = None
+        self.dir_mtime = None
+        self.known_files = set()
+        self.unsettled_files = {}
+        self.pending_files = {}
+        for future in self.features.values():
+            future.cancel()
+        self.features.clear()
+        self.cancel_decode()
         self.pan_start_x = 0
         self.pan_start_y = 0
 
@@ -214,23 +288,53 @@ class ImageTaggingTool:
         if (image_dir := filedialog.askdirectory(title="Select Data Folder")) == "":
             return
 
+        pairs_status, pairs_result = self._scan_pairs(image_dir)
+        if not pairs_status:
+            messagebox.showerror("Error", pairs_result)
+            return
+
+        self.open_data_dir(image_dir, pairs_result)
+
+    def _scan_pairs(self, image_dir: str) -> tuple[bool, str | list[tuple[str, str]]]:
         files = os.listdir(image_dir)
         image_files = list(filter(lambda x: x.lower().endswith(IMG_FILES), files))
 
         pari_status, pairs_result = make_pairs(image_files)
         if not pari_status:
-            messagebox.showerror("Error", pairs_result)
-            return
+            return False, pairs_result
+
+        return select_shard(pairs_result, self.shard)
+
+    def open_data_dir(self, image_dir: str, pairs_result: list[tuple[str, str]], pair_to_load: str = "",
+                      on_loaded: Callable[[], None] | None = None) -> bool:
+        if self.annotator is None:
+            name = get_tag_name_convention(image_dir)
+        else:
+            name = get_shard_tag_name(image_dir, self.annotator)
+        tags_path = os.path.join(image_dir, name)
 
-        name = get_tag_name_convention(image_dir)
-        tags_status, tags_result = read_tags_file(os.path.join(image_dir, name))
+        if tags_path == self.tags_path:
+            lock_path = self.tags_lock  # reopening the folder we already hold
+        else:
+            lock_status, lock_path = acquire_tags_lock(tags_path)
+            if not lock_status:
+                messagebox.showerror("Error", lock_path)
+                return False
+
+        tags_status, tags_result = read_tags_file(tags_path)
         if not tags_status:
+            if lock_path != self.tags_lock:
+                release_tags_lock(lock_path)
             messagebox.showerror("Error", tags_result)
-            return
+            return False
 
         # once everything is open, we can proceed to reset state and load everything
+        if lock_path == self.tags_lock:
+            self.tags_lock = None  # keep it through reset()
         self.reset()
         self.data_dir = image_dir
+        self.tags_path = tags_path
+        self.tags_lock = lock_path
         self.directory_label.configure(text=get_display_dir(image_dir), bg=self.root_bg_color)
 
         for idx, (img0, img1) in enumerate(pairs_result):
@@ -242,29 +346,188 @@ class ImageTaggingTool:
 
         self.dropdown['values'] = list(self.file_index.values())
         self.all_tags = tags_result.get('all_tags', {})
-        pair_to_load = tags_result.get('open_pair_name', "")
+        if pair_to_load not in self.reverse_file_index:
+            pair_to_load = tags_result.get('open_pair_name', "")
         if pair_to_load not in self.reverse_file_index:
             pair_to_load = self.file_index[0]
 
         self._save_scheduler_id = self.root.after(INTERVAL_SAVE, self.save_tags)
+        self._rescan_scheduler_id = self.root.after(INTERVAL_RESCAN, self.rescan)
         self.dropdown.config(state="readonly")
-        self.load_selected_pair(name=pair_to_load)
+        self.load_selected_pair(name=pair_to_load, on_loaded=on_loaded)
+        return True
+
+    def rescan(self):
+        """
+        Cheap folder watcher: only when the folder's mtime changed is it listed again, off the UI thread.
+        New files are taken once their size and mtime hold still between two listings, so that images still being
+        copied in are not loaded half written. The folder is listed again as long as some are not.
+        """
+        self._rescan_scheduler_id = None
+        try:
+            dir_mtime = os.stat(self.data_dir).st_mtime_ns
+        except OSError:
+            dir_mtime = self.dir_mtime
+
+        if dir_mtime == self.dir_mtime and not self.unsettled_files:
+            self._rescan_scheduler_id = self.root.after(INTERVAL_RESCAN, self.rescan)
+        else:
+            future = self.io_pool.submit(stat_image_files, self.data_dir)
+            self._rescan_scheduler_id = self.root.after(INTERVAL_POLL, self._finish_rescan, future, dir_mtime)
+
+    def _finish_rescan(self, future, dir_mtime: int):
+        if not future.done():
+            self._rescan_scheduler_id = self.root.after(INTERVAL_POLL, self._finish_rescan, future, dir_mtime)
+            return
+
+        self._rescan_scheduler_id = self.root.after(INTERVAL_RESCAN, self.rescan)
+        try:
+            files = future.result()
+        except OSError:
+            return
+
+        self.dir_mtime = dir_mtime
+        new_files = {name for name, stat in files.items()
+                     if name not in self.known_files and self.unsettled_files.get(name) == stat}
+        self.unsettled_files = {name: stat for name, stat in files.items()
+                                if name not in self.known_files and name not in new_files}
+        self.known_files = (self.known_files & files.keys()) | new_files
+        new_pairs = [(img0, img1) for img0, img1 in collect_new_pairs(new_files, self.pending_files)
+                     if (base_img_name := os.path.splitext(img0)[0][:-2]) not in self.reverse_file_index
+                     and in_shard_by_name(base_img_name, self.shard)]
+        if new_pairs:
+            self.add_pairs(new_pairs)
+
+    def add_pairs(self, pairs: list[tuple[str, str]]):
+        """
+        Insert pairs into the navigation where opening the folder would list them, by name,
+        leaving the current pair and the loaded data untouched.
+        """
+        new_pairs = [(os.path.join(self.data_dir, img0), os.path.join(self.data_dir, img1)) for img0, img1 in pairs]
+        self._set_pairs(sorted(self.image_pairs + new_pairs, key=lambda pair: os.path.basename(pair[0])))
+
+    def _set_pairs(self, image_pairs: list[tuple[str, str]]):
+        """ Replace the navigation with image_pairs, leaving the current pair and the loaded data untouched. """
+        self.image_pairs = image_pairs
+        self.file_index = {}
+        self.reverse_file_index = {}
+        for idx, (img0, _) in enumerate(self.image_pairs):
+            base_img_name = os.path.splitext(os.path.basename(img0))[0][:-2]
+            self.file_index[idx] = base_img_name
+            self.reverse_file_index[base_img_name] = idx
+
+        self.dropdown['values'] = list(self.file_index.values())
+        if self.current_pair is not None:
+            self._config_nav_buttons()
+
+    def restore_session(self):
+        """ Show the last session's view right away from its snapshot, then load it for real. """
+        snapshot = read_session()
+        if snapshot is None or snapshot["annotator"] != self.annotator or \
+                snapshot["shard"] != (list(self.shard) if self.shard else None):
+            return
+
+        self.directory_label.configure(text=get_display_dir(snapshot["data_dir"]), bg=self.root_bg_color)
+        self.loading_label.configure(text="Loading")
+        img0_name, img1_name = snapshot["pairs"][snapshot["pair_idx"]]
+        self.img0_label.configure(text=img0_name)
+        self.img1_label.configure(text=img1_name)
+
+        for idx, (canvas, view) in enumerate(zip((self.canvas0, self.canvas1), snapshot["canvases"])):
+            if os.path.isfile(preview_path := get_preview_path(idx)):
+                origin_x, origin_y = view["origin"]
+                x0, y0, _, _ = view["preview_region"]
+                canvas.image = tk.PhotoImage(file=preview_path)  # Tk reads PNG itself, PIL is not loaded yet
+                canvas.create_image(origin_x + x0, origin_y + y0, anchor=tk.NW, image=canvas.image, tags="image")
+
+        # let Tk paint the preview before the pair is decoded
+        self.root.after(INTERVAL_RESTORE, self._finish_restore, snapshot)
+
+    def _finish_restore(self, snapshot: dict):
+        data_dir = snapshot["data_dir"]
+        pairs = [tuple(pair) for pair in snapshot["pairs"]]
+        pair_paths = [os.path.join(data_dir, name) for name in pairs[snapshot["pair_idx"]]]
+
+        def on_loaded():
+            for canvas, view in zip((self.canvas0, self.canvas1), snapshot["canvases"]):
+                self.restore_view(canvas, view["scale_idx"], tuple(view["origin"]))
+
+            # the snapshot may be outdated, check it against the folder without blocking the UI
+            future = self.io_pool.submit(self._scan_pairs, data_dir)
+            self.root.after(INTERVAL_POLL, self._finish_validation, future, data_dir, pairs, snapshot["pair_idx"])
+
+        self.loading_label.configure(text="")
+        if not all(map(os.path.isfile, pair_paths)) or \
+                not self.open_data_dir(data_dir, pairs, snapshot["current_pair"], on_loaded):
+            self.canvas0.delete("image")
+            self.canvas1.delete("image")
+
+    def _finish_validation(self, future, data_dir: str, pairs: list[tuple[str, str]], pair_idx: int):
+        if not future.done():
+            self.root.after(INTERVAL_POLL, self._finish_validation, future, data_dir, pairs, pair_idx)
+            return
+
+        if self.data_dir != data_dir:
+            return  # another folder was opened in the meantime
+
+        pairs_status, pairs_result = future.result()
+        if not pairs_status:
+            self.reset()
+            messagebox.showerror("Error", pairs_result)
+        elif pairs_result != pairs:
+            if any(os.path.splitext(img0)[0][:-2] == self.current_pair for img0, _ in pairs_result):
+                # the pair on screen and the tags in memory stay, only the navigation follows the folder
+                self._set_pairs([(os.path.join(data_dir, img0), os.path.join(data_dir, img1))
+                                 for img0, img1 in pairs_result])
+            else:
+                self.write_tags()  # opening the folder again re-reads them
+                current_pair = os.path.splitext(pairs_result[min(pair_idx, len(pairs_result) - 1)][0])[0][:-2]
+                self.open_data_dir(data_dir, pairs_result, current_pair)
+
+    def save_session(self):
+        """ Best effort: a session that cannot be written only means the next launch starts empty. """
+        if not self.loading_done:
+            return
+
+        canvases = []
+        try:
+            ensure_session_dir()
+            for idx, canvas in enumerate((self.canvas0, self.canvas1)):
+                origin = image_origin(canvas)
+                region = get_visible_region(canvas, origin)
+                preview = resample_region(canvas.working, canvas.source_scale, IMG_SCALES[canvas.scale_idx], region,
+                                          RESAMPLE_FINE)
+                if preview.mode == "RGBX":
+                    preview = preview.convert("RGB")  # PNG has no padded RGB
+                preview.save(get_preview_path(idx))
+                canvases.append({"scale_idx": canvas.scale_idx, "origin": list(origin),
+                                 "preview_region": list(region)})
+
+            write_session({"data_dir": self.data_dir,
+                           "annotator": self.annotator,
+                           "shard": list(self.shard) if self.shard else None,
+                           "pairs": [[os.path.basename(img0), os.path.basename(img1)]
+                                     for img0, img1 in self.image_pairs],
+                           "pair_idx": self.reverse_file_index[self.current_pair],
+                           "current_pair": self.current_pair,
+                           "canvases": canvases})
+        except (OSError, ValueError) as e:
+            print(f"Session not saved: {e}")
 
     def on_pair_selected(self, event):
         combo: ttk.Combobox = event.widget
         name = combo.get()
         self.load_selected_pair(name=name)
 
-    def load_selected_pair(self, *, name: str):
+    def load_selected_pair(self, *, name: str, on_loaded: Callable[[], None] | None = None):
+        """ Start loading the named pair; on_loaded is called once its images are on the canvases. """
         self.loading_label.configure(text="Loading")
-        self.root.update_idletasks()
         self.loading_done = False
         self.current_pair = name
-        self._load_current_pair()
-        self.loading_label.configure(text="")
+        self._show_pair_tags()
+        self._load_current_pair(on_loaded)
 
-    def _load_current_pair(self):
-        # Configure Next/Prev buttons
+    def _config_nav_buttons(self):
         self.button_prev.config(state=tk.NORMAL)
         self.button_next.config(state=tk.NORMAL)
         if self.reverse_file_index[self.current_pair] == 0:
@@ -272,6 +535,9 @@ class ImageTaggingTool:
         if self.reverse_file_index[self.current_pair] + 1 == len(self.image_pairs):
             self.button_next.config(state=tk.DISABLED)
 
+    def _show_pair_tags(self):
+        self._config_nav_buttons()
+
         # Load tags for pair
         self.tag_list.delete(0, tk.END)
         self.button_clear_all.config(state=tk.DISABLED)
@@ -283,31 +549,177 @@ class ImageTaggingTool:
         if self.points:
             self.button_clear_all.config(state=tk.NORMAL)
 
-        # Load images
         img0_path, img1_path = self.image_pairs[self.reverse_file_index[self.current_pair]]
-        img0 = Image.open(img0_path)
-        img1 = Image.open(img1_path)
-        img0_name = os.path.basename(img0_path)
-        img1_name = os.path.basename(img1_path)
+        self.img0_label.configure(text=os.path.basename(img0_path))
+        self.img1_label.configure(text=os.path.basename(img1_path))
 
-        self.img0_label.configure(text=img0_name)
-        self.img1_label.configure(text=img1_name)
+    def _load_current_pair(self, on_loaded: Callable[[], None] | None = None):
+        img0_path, img1_path = self.image_pairs[self.reverse_file_index[self.current_pair]]
+
+        # Decode both images and their zoom pyramids in parallel worker processes, the UI stays responsive
+        self.cancel_decode()
+        if self.decode_pool is None:
+            # spawn, as forking a process with Tk and running threads is not safe
+            self.decode_pool = ProcessPoolExecutor(DECODE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        for canvas, path in ((self.canvas0, img0_path), (self.canvas1, img1_path)):
+            plan_status, plan_result = plan_decode(path, self.max_edge, IMG_SCALES)
+            if not plan_status:
+                self.cancel_decode()
+                self._fail_load(f"{os.path.basename(path)}: {plan_result}")
+                return
+
+            segments, spec = plan_result
+            try:
+                future = self.decode_pool.submit(decode_into, path, spec)
+            except BrokenProcessPool as e:
+                self.busy_segments += release_segments(segments)
+                self.cancel_decode()
+                self._drop_decode_pool()
+                self._fail_load(f"{os.path.basename(path)}: {e}")
+                return
+
+            self.decode_jobs.append((canvas, path, segments, spec, future))
+
+        self.root.after(INTERVAL_DECODE_POLL, self._finish_load, self.decode_jobs, on_loaded)
+
+    def cancel_decode(self):
+        for _, _, segments, _, future in self.decode_jobs:
+            future.cancel()
+            self.busy_segments += release_segments(segments)
+        self.decode_jobs = []
+
+    def _drop_decode_pool(self):
+        """ A worker died, out of memory on a large scan say: the pool is broken, the next load starts a new one. """
+        self.decode_pool.shutdown(wait=False, cancel_futures=True)
+        self.decode_pool = None
+
+    def _finish_load(self, jobs: list, on_loaded: Callable[[], None] | None):
+        if jobs is not self.decode_jobs:
+            return  # another pair was selected in the meantime
+
+        if not all(future.done() for *_, future in jobs):
+            self.root.after(INTERVAL_DECODE_POLL, self._finish_load, jobs, on_loaded)
+            return
+
+        errors = [(path, future.exception()) for _, path, _, _, future in jobs if future.exception() is not None]
+        if errors:
+            self.cancel_decode()
+            if any(isinstance(error, BrokenProcessPool) for _, error in errors):
+                self._drop_decode_pool()
+            path, error = errors[0]
+            self._fail_load(f"{os.path.basename(path)}: {error}")
+            return
 
-        # Generate zoom pyramids
-        self.canvas0.scaled_images = generate_image_pyramid(img0, IMG_SCALES)
-        self.canvas1.scaled_images = generate_image_pyramid(img1, IMG_SCALES)
+        self.decode_jobs = []
+        released = []
+        for canvas, path, segments, spec, _ in jobs:
+            released += load_shared_images(canvas, path, segments, spec)
+        self.busy_segments = release_segments(self.busy_segments + released)
+        self.refine_pool.submit(forget_decoded_pages)
 
         # Put images on canvases
-        put_image_on_canvas(self.canvas0, self.canvas0.scaled_images[self.canvas0.scale_idx])
-        put_image_on_canvas(self.canvas1, self.canvas1.scaled_images[self.canvas1.scale_idx])
+        show_zoom_level(self.canvas0, (0, 0))
+        show_zoom_level(self.canvas1, (0, 0))
 
-        # center images and reset zoom
-        self.scale_to(self.canvas0, NEUTRAL_ZOOM_IDX)
-        self.scale_to(self.canvas1, NEUTRAL_ZOOM_IDX)
+        # center images and reset zoom, in working-resolution mode to the most the working image shows in full
+        self.scale_to(self.canvas0, get_start_zoom_idx(self.canvas0))
+        self.scale_to(self.canvas1, get_start_zoom_idx(self.canvas1))
 
         self.loading_done = True
+        self.shown_pair = self.current_pair
+        self.loading_label.configure(text="")
         self.dropdown.set(self.current_pair)
         self.poll_cursor_position()
+        self.precompute_features()
+        if on_loaded is not None:
+            on_loaded()
+
+    def _fail_load(self, message: str):
+        """ Report a pair that could not be loaded, and go back to the pair whose images are still shown. """
+        failed_pair = self.current_pair
+        self.loading_label.configure(text="")
+        if self.shown_pair in self.reverse_file_index:  # not dropped from the folder since
+            self.current_pair = self.shown_pair
+            self._show_pair_tags()
+            self.redraw_points(self.canvas0)
+            self.redraw_points(self.canvas1)
+            self.dropdown.set(self.shown_pair)
+            self.loading_done = True
+        else:
+            # nothing of this folder is loaded yet, the pair stays selected so that next/prev can move past it
+            for canvas in (self.canvas0, self.canvas1):
+                canvas.delete("image", "refined", "point")
+            self.dropdown.set(failed_pair)
+
+        messagebox.showerror("Error", f"Could not load {failed_pair}.\n{message}")
+
+    def precompute_features(self):
+        """ Queue keypoint detection for the current pair and its neighbours, in worker processes. """
+        # a worker died, out of memory on a large scan say: the pool is broken, its pairs are queued on a new one
+        for name, future in list(self.features.items()):
+            if future.done() and not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+                del self.features[name]
+                self._drop_feature_pool()
+
+        if self.feature_pool is None:
+            if importlib.util.find_spec("numpy") is None:
+                return  # match suggestions need numpy
+
+            # spawn, as forking a process with Tk and running threads is not safe
+            self.feature_pool = ProcessPoolExecutor(FEATURE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+        from matching import compute_pair_features
+
+        curr_idx = self.reverse_file_index[self.current_pair]
+        window = [curr_idx]
+        for step in range(1, FEATURE_LOOKAHEAD + 1):
+            window += [curr_idx + step, curr_idx - step]
+        names = [self.file_index[idx] for idx in window if idx in self.file_index]
+
+        # drop queued work for pairs we navigated away from, so the current pair is not stuck behind it
+        for name, future in list(self.features.items()):
+            if name not in names and not future.done() and future.cancel():
+                del self.features[name]
+
+        for name in names:
+            if name in self.features:
+                self.features.move_to_end(name)
+            else:
+                img0_path, img1_path = self.image_pairs[self.reverse_file_index[name]]
+                try:
+                    self.features[name] = self.feature_pool.submit(compute_pair_features, img0_path, img1_path)
+                except BrokenProcessPool:
+                    self._drop_feature_pool()  # the next call queues the rest on a new one
+                    return
+
+        while len(self.features) > FEATURE_CACHE_SIZE:
+            _, future = self.features.popitem(last=False)
+            future.cancel()
+
+    def _drop_feature_pool(self):
+        if self.feature_pool is not None:
+            self.feature_pool.shutdown(wait=False, cancel_futures=True)
+            self.feature_pool = None
+
+    def suggest_twin_point(self, canvas: Canvas, img_point: tuple[float, float]):
+        """ Propose the point matching img_point on the twin canvas, if the pair's keypoints are ready. """
+        future = self.features.get(self.current_pair)
+        if future is None or not future.done() or future.cancelled() or future.exception() is not None:
+            return
+
+        from matching import suggest_match
+
+        features0, features1 = future.result()
+        if canvas is self.canvas0:
+            suggestion = suggest_match(features0, features1, img_point)
+        else:
+            suggestion = suggest_match(features1, features0, img_point)
+
+        twin_w, twin_h = canvas.twin.source_size
+        if suggestion is not None and 0 <= suggestion[0] < twin_w and 0 <= suggestion[1] < twin_h:
+            canvas.twin.temp_point = suggestion
+            canvas.twin.suggested = True
+            self.redraw_points(canvas.twin)
 
     def redraw_points(self, canvas: Canvas):
         # clear canvas first
@@ -332,8 +744,9 @@ class ImageTaggingTool:
             dim = 1 + pt_size * 2
             canvas_x, canvas_y = in_canvas_coords(point, canvas)
             x1, y1, x2, y2 = get_centered_oval_bbox((canvas_x, canvas_y), dim, dim, PT_OUTLINE_WIDTH)
+            fill, outline = ("#FFFFFF", "#000000") if canvas.suggested else ("#000000", "#FFFFFF")
             canvas.create_oval(x1, y1, x2, y2, width=PT_OUTLINE_WIDTH,
-                               fill="#000000", outline="#FFFFFF", tags="point")
+                               fill=fill, outline=outline, tags="point")
             canvas.tag_text.configure(text=f"({point[0]:.1f}, {point[1]:.1f})", fg="black")
 
     def on_click(self, event):
@@ -355,12 +768,13 @@ class ImageTaggingTool:
         # If tagging
         else:
             click_canvas: Canvas = event.widget
-            if click_canvas.temp_point:
+            if click_canvas.temp_point and not click_canvas.suggested:
                 return  # ignore, this canvas already has a clicked point
 
             elif (img_point := in_image_coords(event.x, event.y, click_canvas)) != (-1, -1):
 
-                if not click_canvas.twin.temp_point:
+                first_point = not click_canvas.twin.temp_point
+                if first_point:
                     if (close_point_idx := find_closest(img_point, click_canvas.points, click_canvas.scale_idx - NEUTRAL_ZOOM_IDX)) != -1:
                         self.on_tag_selected_from_image(close_point_idx)
                         return
@@ -370,7 +784,10 @@ class ImageTaggingTool:
                     click_canvas.twin.tag_text.configure(text="")
 
                 click_canvas.temp_point = img_point
+                click_canvas.suggested = False
                 self.redraw_points(click_canvas)
+                if first_point:
+                    self.suggest_twin_point(click_canvas, img_point)
             else:
                 return  # ignore, clicked outside of image
 
@@ -385,6 +802,8 @@ class ImageTaggingTool:
 
             self.canvas0.temp_point = None
             self.canvas1.temp_point = None
+            self.canvas0.suggested = False
+            self.canvas1.suggested = False
 
             self.redraw_points(self.canvas0)
             self.redraw_points(self.canvas1)
@@ -483,9 +902,16 @@ class ImageTaggingTool:
         canvas: Canvas = event.widget  # Only triggers when clicking on a canvas...
         if canvas.temp_point:
             canvas.temp_point = None
+            canvas.suggested = False
             canvas.tag_text.configure(text="")
             self.redraw_points(canvas)
 
+            if canvas.twin.suggested:  # the suggestion was made for the point just removed
+                canvas.twin.temp_point = None
+                canvas.twin.suggested = False
+                canvas.twin.tag_text.configure(text="")
+                self.redraw_points(canvas.twin)
+
         else:
             self._clear_tag_select()
 
@@ -502,7 +928,7 @@ class ImageTaggingTool:
             inside = True
             canvas_x, canvas_y = canvas_pt
             zoom_scale = self.canvas0.zoom_scale
-            image_x, image_y = self.canvas0.coords("image")
+            image_x, image_y = image_origin(self.canvas0)
             self.img0_cursor_txt.configure(text=f"{((canvas_x - image_x) / zoom_scale):.1f}, "
                                                 f"{((canvas_y - image_y) / zoom_scale):.1f}")
             self.img1_cursor_txt.configure(text="")  # Clear text when outside
@@ -511,7 +937,7 @@ class ImageTaggingTool:
             inside = True
             canvas_x, canvas_y = canvas_pt
             zoom_scale = self.canvas1.zoom_scale
-            image_x, image_y = self.canvas1.coords("image")
+            image_x, image_y = image_origin(self.canvas1)
             self.img1_cursor_txt.configure(text=f"{((canvas_x - image_x) / zoom_scale):.1f}, "
                                                 f"{((canvas_y - image_y) / zoom_scale):.1f}")
             self.img0_cursor_txt.configure(text="")  # Clear text when outside
@@ -538,13 +964,15 @@ class ImageTaggingTool:
             self.tag_mode = True
 
     def pan_image(self, event):
-        if not self.tag_mode:
+        if self.loading_done and not self.tag_mode:
             # Calculate the distance moved
             dx = event.x - self.pan_start_x
             dy = event.y - self.pan_start_y
 
             # Adjust the view of the canvas
             event.widget.move("image", dx, dy)
+            refresh_region(event.widget)
+            self.schedule_refine(event.widget)
 
             # Update the starting point
             self.pan_start_x = event.x
@@ -568,6 +996,7 @@ class ImageTaggingTool:
             event_point = event.x, event.y
             canvas.scale_idx += 1
             apply_image_scaling(canvas, event_point)
+            self.schedule_refine(canvas)
             self.redraw_points(canvas)
 
     def scale_down(self, event):
@@ -576,6 +1005,7 @@ class ImageTaggingTool:
             event_point = event.x, event.y
             canvas.scale_idx -= 1
             apply_image_scaling(canvas, event_point)
+            self.schedule_refine(canvas)
             self.redraw_points(canvas)
 
     def scale_to(self, canvas: Canvas, idx: int):
@@ -584,14 +1014,58 @@ class ImageTaggingTool:
 
         canvas.scale_idx = idx
         apply_image_scaling(canvas, (0, 0))
+        self.schedule_refine(canvas)
         self.redraw_points(canvas)
 
+    def restore_view(self, canvas: Canvas, idx: int, origin: tuple[float, float]):
+        canvas.scale_idx = idx
+        canvas.zoom_scale = IMG_SCALES[idx]
+        show_zoom_level(canvas, origin)
+        self.schedule_refine(canvas)
+        self.redraw_points(canvas)
+
+    def schedule_refine(self, canvas: Canvas):
+        """ Drop any stale refinement and re-render the visible region with the fine filter once input is idle. """
+        if canvas.refine_id is not None:
+            self.root.after_cancel(canvas.refine_id)
+        if canvas.refine_future is not None:
+            canvas.refine_future.cancel()
+            canvas.refine_future = None
+
+        canvas.delete("refined")
+        canvas.refined = None
+        canvas.refine_generation += 1
+        canvas.refine_id = self.root.after(INTERVAL_REFINE, self._start_refine, canvas)
+
+    def _start_refine(self, canvas: Canvas):
+        canvas.refine_id = None
+        origin = image_origin(canvas)
+        region = get_visible_region(canvas, origin)
+        future = self.refine_pool.submit(*get_refine_job(canvas, region))
+        canvas.refine_future = future
+        self.root.after(INTERVAL_REFINE_POLL, self._finish_refine, canvas, future, origin, region)
+
+    def _finish_refine(self, canvas: Canvas, future, origin: tuple[float, float], region: tuple[int, int, int, int]):
+        if future is not canvas.refine_future:
+            return  # the view changed since, a newer refinement is on its way
+
+        if not future.done():
+            self.root.after(INTERVAL_REFINE_POLL, self._finish_refine, canvas, future, origin, region)
+            return
+
+        from PIL import ImageTk
+
+        canvas.refine_future = None
+        origin_x, origin_y = origin
+        x0, y0, _, _ = region
+        put_refined_on_canvas(canvas, ImageTk.PhotoImage(future.result()), (origin_x + x0, origin_y + y0))
+
     def on_focus_out(self, event):
         # Any held keys should be treated as released!
         self.tag_mode = True
 
     def prev_pair(self):
-        if not self.loading_done:
+        if self.current_pair is None or self.decode_jobs:
             return
 
         curr_idx = self.reverse_file_index[self.current_pair]
@@ -600,7 +1074,7 @@ class ImageTaggingTool:
             self.load_selected_pair(name=name)
 
     def next_pair(self):
-        if not self.loading_done:
+        if self.current_pair is None or self.decode_jobs:
             return
 
         curr_idx = self.reverse_file_index[self.current_pair]
@@ -610,20 +1084,29 @@ class ImageTaggingTool:
 
     def save_tags(self):
         if self.current_pair is not None and self.loading_done:
-            name = get_tag_name_convention(self.data_dir)
-            tags_path = os.path.join(self.data_dir, name)
-            payload = {"open_pair_name": self.current_pair,
-                       "timestamp": "",
-                       "all_tags": self.all_tags}
-
-            with open(tags_path, "w") as f:
-                json.dump(payload, f)
+            self.write_tags()
 
         self._save_scheduler_id = self.root.after(INTERVAL_SAVE, self.save_tags)
 
+    def write_tags(self):
+        payload = {"open_pair_name": self.current_pair,
+                   "timestamp": "",
+                   "all_tags": self.all_tags}
+
+        # replaced in one step, so a merge or a crash never sees a half-written file
+        with open(f"{self.tags_path}.tmp", "w") as f:
+            json.dump(payload, f)
+        os.replace(f"{self.tags_path}.tmp", self.tags_path)
+
     def quit_event(self, event):
         if self.debug:
-            self.root.quit()
+            self.close()
         else:
             if messagebox.askyesno("Confirmation", "Exit?"):
-                self.root.quit()
+                self.close()
+
+    def close(self):
+        try:
+            self.save_session()
+        finally:
+            self.root.quit()  # whatever goes wrong, the tool can still be closed
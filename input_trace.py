@@ -0,0 +1,382 @@
+"""
+Input traces: record the events an annotator feeds the tool's handlers, then replay them against a dataset to
+measure per-handler latency and frame times, so builds can be compared on real annotation sessions.
+
+Record with `python main.py --record-trace session.trace`, then replay with
+
+    python input_trace.py session.trace DATA_DIR --report build.json [--baseline previous.json]
+
+A trace is JSON lines: a header, then one record per handler call with its time since the start of recording.
+Whenever the pair changes, the record also carries the pair's tags and both canvas views, so that the replay
+starts every pair from the same state whatever happened in between. Each record also notes which canvases showed
+their idle refinement, and clicks whether they brought up a match suggestion: both depend on background work, so
+the replay waits for, or withholds, that work to reproduce them. Tags are never saved during a replay.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+from constants import __VERSION__
+
+TRACED_HANDLERS = ("on_canvas_click", "pan_image", "scale_up", "scale_down", "confirm_tag", "delete_tag",
+                   "undo_point", "mode_switch", "on_focus_out", "clear_all_tags", "on_tag_selected_from_list",
+                   "clear_tag_selection_inside", "on_pair_selected", "next_pair", "prev_pair")
+UNGATED_HANDLERS = ("mode_switch", "on_focus_out", "on_pair_selected")  # they act whether a pair is loaded or not
+PAIR_HANDLERS = ("on_pair_selected", "next_pair", "prev_pair")
+SELECTION_HANDLERS = ("delete_tag", "on_tag_selected_from_list", "clear_tag_selection_inside")  # read the tag list
+NO_EVENT_HANDLERS = ("next_pair", "prev_pair", "clear_all_tags")  # called without an event
+FRAME_BUCKETS_MS = (4, 8, 16, 33, 50, 100, 250)
+PERCENTILES = (50, 90, 99)
+
+
+class TraceRecorder:
+    """ Wraps the traced handlers of a tool, before they are bound to widgets, to log every call. """
+
+    def __init__(self, path: str):
+        self.file = open(path, "w", buffering=1)  # line buffered, a crash keeps everything up to the last event
+        self.start = time.perf_counter()
+        self.tool = None
+        self.synced_pair = None
+        self.depth = 0
+        self.suggested = False  # whether the click being recorded brought up a suggestion
+
+    def install(self, tool):
+        self.tool = tool
+        for name in TRACED_HANDLERS:
+            setattr(tool, name, self.wrap(name, getattr(tool, name)))
+
+        suggest_twin_point = tool.suggest_twin_point
+
+        def traced_suggest(canvas, img_point):
+            suggest_twin_point(canvas, img_point)
+            self.suggested = canvas.twin.temp_point is not None
+
+        tool.suggest_twin_point = traced_suggest
+
+    def wrap(self, name: str, handler):
+        def traced(*args):
+            # only the outermost call is an input, handlers calling each other are replayed by the first one
+            entry = None
+            if self.depth == 0 and self.accepts(name):
+                entry = self.make_entry(name, args[0] if args else None)
+                self.suggested = False
+
+            self.depth += 1
+            try:
+                return handler(*args)
+            finally:
+                self.depth -= 1
+                if entry is not None:
+                    if name == "on_canvas_click":
+                        entry["suggested"] = self.suggested
+                    elif name == "clear_all_tags":
+                        entry["confirmed"] = not self.tool.points  # answered yes to the confirmation dialog
+                    self.file.write(json.dumps(entry) + "\n")
+
+        return traced
+
+    def accepts(self, name: str) -> bool:
+        """ Whether the handler acts on input right now, calls that are ignored are not recorded. """
+        tool = self.tool
+        if name in UNGATED_HANDLERS:
+            return True
+        if name in ("next_pair", "prev_pair"):
+            return tool.current_pair is not None and not tool.decode_jobs
+        return tool.loading_done
+
+    def make_entry(self, name: str, event) -> dict:
+        """ The record of a call, from the state before it. Written once the handler is done. """
+        tool = self.tool
+        if self.file.tell() == 0:
+            self.file.write(json.dumps({"version": __VERSION__,
+                                        "max_edge": tool.max_edge,
+                                        "canvas_size": [int(tool.canvas0.cget("width")),
+                                                        int(tool.canvas0.cget("height"))]}) + "\n")
+
+        entry = {"t": round(time.perf_counter() - self.start, 4), "handler": name,
+                 "refined": [canvas.refined is not None for canvas in (tool.canvas0, tool.canvas1)]}
+        if tool.current_pair != self.synced_pair and tool.current_pair is not None:
+            entry["pair"] = self.synced_pair = tool.current_pair
+            entry["points"] = list(tool.points)  # written after the handler, which may edit them
+            entry["views"] = get_views(tool)
+
+        if event is not None:
+            widgets = ((tool.canvas0, "canvas0"), (tool.canvas1, "canvas1"), (tool.tag_list, "tag_list"),
+                       (tool.dropdown, "dropdown"))
+            entry["widget"] = next((label for widget, label in widgets if widget is event.widget), "root")
+            entry["x"], entry["y"] = getattr(event, "x", 0), getattr(event, "y", 0)
+            event_type = getattr(event, "type", "")
+            entry["type"] = str(getattr(event_type, "value", event_type))  # tk.EventType, compared as "2", "3"...
+            if name in SELECTION_HANDLERS:
+                entry["selection"] = list(tool.tag_list.curselection())
+            elif name == "on_pair_selected":
+                entry["value"] = tool.dropdown.get()
+
+        return entry
+
+    def close(self):
+        self.file.close()
+
+
+def get_views(tool) -> list[tuple[int, tuple[float, float]]]:
+    from utils import image_origin
+
+    return [(canvas.scale_idx, tuple(round(v, 1) for v in image_origin(canvas)))
+            for canvas in (tool.canvas0, tool.canvas1)]
+
+
+def is_refine_pending(canvas) -> bool:
+    """ Whether an idle refinement is scheduled or on its way, a failed one never lands. """
+    future = canvas.refine_future
+    return canvas.refine_id is not None or \
+        (future is not None and not (future.done() and future.exception() is not None))
+
+
+def as_points(points: list) -> list[tuple[tuple[float, float], tuple[float, float]]]:
+    """ Tags read from JSON are nested lists, clicked ones tuples. """
+    return [(tuple(p0), tuple(p1)) for p0, p1 in points]
+
+
+def read_trace(path: str) -> tuple[bool, str | tuple[dict, list[dict]]]:
+    try:
+        with open(path, "r") as f:
+            lines = [json.loads(line) for line in f if line.strip()]
+    except (OSError, ValueError) as e:
+        return False, f"Cannot read trace {path}: {e}"
+
+    if not lines or "version" not in lines[0]:
+        return False, f"{path} is empty or not a trace."
+
+    return True, (lines[0], lines[1:])
+
+
+def percentile(values: list[float], q: float) -> float:
+    """ Nearest-rank percentile. """
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))]
+
+
+def frame_histogram(frames_ms: list[float]) -> dict[str, int]:
+    histogram = {f"<{bound}ms": 0 for bound in FRAME_BUCKETS_MS}
+    histogram[f">={FRAME_BUCKETS_MS[-1]}ms"] = 0
+    for frame in frames_ms:
+        label = next((f"<{bound}ms" for bound in FRAME_BUCKETS_MS if frame < bound), f">={FRAME_BUCKETS_MS[-1]}ms")
+        histogram[label] += 1
+
+    return histogram
+
+
+class Replayer:
+    """ Feeds a trace into a live tool. Every pass of the Tk event loop is timed as a frame. """
+
+    def __init__(self, tool, speed: float):
+        self.tool = tool
+        self.speed = speed
+        self.latencies: dict[str, list[float]] = {}
+        self.frames_ms: list[float] = []
+        # suggestions are shown only where the recording showed them, see settle
+        self.suggestion = True
+        self.suggest_twin_point = tool.suggest_twin_point
+        tool.suggest_twin_point = self.replay_suggestion
+
+    def pump(self, duration_s: float = 0):
+        deadline = time.perf_counter() + duration_s
+        while True:
+            start = time.perf_counter()
+            self.tool.root.update()
+            self.frames_ms.append((time.perf_counter() - start) * 1000)
+            if time.perf_counter() >= deadline:
+                return
+            time.sleep(0.001)
+
+    def wait_loaded(self) -> float:
+        start = time.perf_counter()
+        while self.tool.decode_jobs:
+            self.pump(0.002)
+        return (time.perf_counter() - start) * 1000
+
+    def replay_suggestion(self, canvas, img_point: tuple[float, float]):
+        if self.suggestion:
+            self.suggest_twin_point(canvas, img_point)
+
+    def settle(self, entry: dict):
+        """
+        Put the background work in the state it was in when the entry was recorded: the pair's keypoints ready if the
+        click brought up a suggestion, and on each canvas the idle refinement shown or not.
+        """
+        tool = self.tool
+        self.suggestion = entry.get("suggested", True)  # traces without it replay suggestions as they come
+        if entry.get("suggested"):
+            future = tool.features.get(tool.current_pair)
+            while future is not None and not future.done():
+                self.pump(0.002)
+
+        for canvas, refined in zip((tool.canvas0, tool.canvas1), entry.get("refined", ())):
+            if refined:
+                while canvas.refined is None and is_refine_pending(canvas):
+                    self.pump(0.002)
+            elif canvas.refined is not None:
+                tool.schedule_refine(canvas)  # landed earlier than when recorded, it lands again after the event
+
+    def sync(self, entry: dict):
+        """ Put the pair in the state it was recorded in. """
+        tool = self.tool
+        points = as_points(entry["points"])
+        views = [(scale_idx, tuple(origin)) for scale_idx, origin in entry["views"]]
+        if tool.current_pair == entry["pair"] and as_points(tool.points) == points and get_views(tool) == views:
+            return
+
+        tool.all_tags[entry["pair"]] = points
+        tool.load_selected_pair(name=entry["pair"])
+        self.wait_loaded()
+        for canvas, (scale_idx, origin) in zip((tool.canvas0, tool.canvas1), views):
+            tool.restore_view(canvas, scale_idx, origin)
+        self.pump()
+
+    def dispatch(self, entry: dict):
+        tool = self.tool
+        name = entry["handler"]
+        args = () if name in NO_EVENT_HANDLERS else (None,)
+        if "widget" in entry:
+            widget = {"canvas0": tool.canvas0, "canvas1": tool.canvas1, "tag_list": tool.tag_list,
+                      "dropdown": tool.dropdown, "root": tool.root}[entry["widget"]]
+            args = (SimpleNamespace(widget=widget, x=entry["x"], y=entry["y"], type=entry["type"]),)
+            if name in SELECTION_HANDLERS:
+                tool.tag_list.selection_clear(0, "end")
+                for idx in entry["selection"]:
+                    tool.tag_list.selection_set(idx)
+            elif name == "on_pair_selected":
+                tool.dropdown.set(entry["value"])
+
+        if name == "clear_all_tags":
+            if not entry.get("confirmed"):
+                return  # the annotator said no, nothing happened
+            from image_tagging_tool import messagebox
+
+            ask = messagebox.askyesno
+            messagebox.askyesno = lambda *_: True
+            try:
+                self.call(name, args)
+            finally:
+                messagebox.askyesno = ask
+        else:
+            self.call(name, args)
+
+        if name in PAIR_HANDLERS and tool.decode_jobs:
+            self.latencies.setdefault("pair_load", []).append(self.wait_loaded())
+
+    def call(self, name: str, args: tuple):
+        tool = self.tool
+        start = time.perf_counter()
+        getattr(tool, name)(*args)
+        tool.root.update_idletasks()  # until the result is drawn
+        self.latencies.setdefault(name, []).append((time.perf_counter() - start) * 1000)
+
+    def run(self, entries: list[dict]):
+        last_t = None
+        for entry in entries:
+            self.wait_loaded()
+            if "pair" in entry:
+                self.sync(entry)
+            elif last_t is not None and self.speed > 0:
+                self.pump((entry["t"] - last_t) / self.speed)  # keep the annotator's pace
+            last_t = entry["t"]
+            self.settle(entry)
+            self.dispatch(entry)
+
+        self.pump(0.5)  # let trailing refinements land
+
+    def report(self) -> dict:
+        return {"handlers": {name: {"count": len(values),
+                                    **{f"p{q}": round(percentile(values, q), 2) for q in PERCENTILES},
+                                    "max": round(max(values), 2)}
+                             for name, values in sorted(self.latencies.items())},
+                "frames": frame_histogram(self.frames_ms)}
+
+
+def print_report(report: dict, baseline: dict | None):
+    print(f"{'handler':<16}{'count':>7}" + "".join(f"{f'p{q} ms':>10}" for q in PERCENTILES) + f"{'max ms':>10}")
+    for name, stats in report["handlers"].items():
+        line = f"{name:<16}{stats['count']:>7}" + "".join(f"{stats[f'p{q}']:>10.2f}" for q in PERCENTILES)
+        line += f"{stats['max']:>10.2f}"
+        if baseline is not None and name in baseline["handlers"]:
+            before = baseline["handlers"][name]["p90"]
+            line += f"   p90 {stats['p90'] - before:+.2f} ms vs baseline"
+        print(line)
+
+    print("Frame times:")
+    total = max(1, sum(report["frames"].values()))
+    for label, count in report["frames"].items():
+        print(f"  {label:>8} {count:>8} {100 * count / total:6.1f}%")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="Trace recorded with main.py --record-trace.")
+    parser.add_argument("data_dir", help="The dataset the trace was recorded on.")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Replay speed relative to the recording, 0 sends events as fast as possible.")
+    parser.add_argument("--max-edge", type=int, default=None, help="Override the recorded working-resolution cap.")
+    parser.add_argument("--small-window", action="store_true", help="Force the window to small size.")
+    parser.add_argument("--tiny-window", action="store_true", help="Force the window to tiny size.")
+    parser.add_argument("--report", default=None, help="Write the latency report to this JSON file.")
+    parser.add_argument("--baseline", default=None, help="A previous --report to compare against.")
+    args = parser.parse_args()
+
+    trace_status, trace_result = read_trace(args.trace)
+    if not trace_status:
+        print(trace_result)
+        return 1
+    header, entries = trace_result
+
+    from soak import start_xvfb, has_display
+
+    xvfb = start_xvfb()
+    if not has_display():
+        print("Replay needs a display, or Xvfb to start one.")
+        return 1
+
+    from image_tagging_tool import ImageTaggingTool
+
+    tool = ImageTaggingTool(args.small_window, args.tiny_window, args.max_edge or header["max_edge"], run=False)
+    tool.debug = True
+    tool.write_tags = lambda: None  # a replay never writes tags
+    try:
+        canvas_size = [int(tool.canvas0.cget("width")), int(tool.canvas0.cget("height"))]
+        if canvas_size != header["canvas_size"]:
+            print(f"Warning: canvases are {canvas_size}, the trace was recorded on {header['canvas_size']}. "
+                  f"Use --small-window or --tiny-window to match, or clicks land elsewhere.")
+
+        pairs_status, pairs = tool._scan_pairs(os.path.abspath(args.data_dir))
+        if not pairs_status or not tool.open_data_dir(os.path.abspath(args.data_dir), pairs):
+            print(f"Cannot open {args.data_dir}: {pairs}")
+            return 1
+
+        replayer = Replayer(tool, args.speed)
+        replayer.run(entries)
+    finally:
+        tool.shutdown()
+        tool.root.destroy()
+        if xvfb is not None:
+            xvfb.terminate()
+
+    report = replayer.report()
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=2)
+
+    return 0
+
+
+if "__main__" == __name__:
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import argparse
+import multiprocessing
 
 from constants import __VERSION__
 import sys
@@ -15,12 +16,100 @@ def log_exceptions(exc_type, exc_value, exc_traceback):
 
 
 if "__main__" == __name__:
+    multiprocessing.freeze_support()  # worker processes of the frozen executable start here
     sys.excepthook = log_exceptions
     parser = argparse.ArgumentParser()
     parser.add_argument("--small-window", action="store_true", help="Force the window to small size.")
     parser.add_argument("--tiny-window", action="store_true", help="Force the window to tiny size.")
+    parser.add_argument("--max-edge", type=int, default=None,
+                        help="Working-resolution mode: cap the decoded long edge of each image to this many pixels.")
+    parser.add_argument("--annotator", default=None,
+                        help="Save tags to a per-annotator file, tags_<dir>_<annotator>_.json.")
+    parser.add_argument("--shard", default=None,
+                        help="Only open part of the folder: range:START:END (pair indices) or hash:K/N.")
+    parser.add_argument("--merge", metavar="DATA_DIR", default=None,
+                        help="Merge all per-annotator tag files of DATA_DIR into its canonical tags file and exit.")
+    parser.add_argument("--export-tags", nargs=2, metavar=("TAGS_FILE", "OUT_FILE"), default=None,
+                        help="Convert a tags file to the compact binary .tagsbin format and exit.")
+    parser.add_argument("--import-tags", nargs=2, metavar=("TAGS_FILE", "OUT_FILE"), default=None,
+                        help="Convert a tags file (JSON or .tagsbin) to a JSON tags file and exit.")
+    parser.add_argument("--record-trace", metavar="TRACE_FILE", default=None,
+                        help="Record the input events of this session for replay with input_trace.py.")
+    parser.add_argument("--export-overlays", nargs=2, metavar=("DATA_DIR", "OUT_DIR"), default=None,
+                        help="Render every pair of DATA_DIR side by side with its tags into OUT_DIR, with an "
+                             "index.html contact sheet, and exit.")
+    parser.add_argument("--overlay-size", type=int, nargs=2, metavar=("W", "H"), default=None,
+                        help="Size each overlay is downscaled to fit in.")
+    parser.add_argument("--overlay-lines", action="store_true", help="Connect corresponding points in overlays.")
+    parser.add_argument("--workers", type=int, default=None, help="Processes for --export-overlays.")
     args = parser.parse_args()
 
+    if args.export_overlays is not None:
+        from constants import OVERLAY_SIZE
+        from overlays import plan_overlays, export_overlays
+
+        data_dir, out_dir = args.export_overlays
+        jobs_status, jobs = plan_overlays(data_dir, out_dir, tuple(args.overlay_size or OVERLAY_SIZE),
+                                          args.overlay_lines)
+        if not jobs_status:
+            sys.exit(jobs)
+
+        n_failed = 0
+        for done, (status, result) in enumerate(export_overlays(jobs, out_dir, args.workers), 1):
+            if not status:
+                n_failed += 1
+                print(f"FAILED {result}")
+            if done % 100 == 0 or done == len(jobs):
+                print(f"{done}/{len(jobs)}", flush=True)
+        print(f"Exported {len(jobs) - n_failed} overlays to {out_dir}, {n_failed} failed.")
+        sys.exit(1 if n_failed else 0)
+
+    if args.export_tags is not None or args.import_tags is not None:
+        import json
+        from binary_tags import write_binary_tags
+        from utils import read_tags_file
+
+        src_path, dst_path = args.export_tags or args.import_tags
+        tags_status, tags_result = read_tags_file(src_path)
+        if not tags_status or not tags_result:
+            sys.exit(tags_result or f"{src_path} not found")
+
+        if args.export_tags is not None:
+            write_binary_tags(dst_path, tags_result)
+        else:
+            with open(dst_path, "w") as f:
+                json.dump(tags_result, f)
+        sys.exit(0)
+
+    if args.merge is not None:
+        import os
+        from shards import merge_shards, acquire_tags_lock, release_tags_lock
+        from utils import get_tag_name_convention
+
+        lock_status, lock_path = acquire_tags_lock(os.path.join(args.merge, get_tag_name_convention(args.merge)))
+        if not lock_status:
+            sys.exit(lock_path)
+        try:
+            n_pairs, conflicts, unreadable = merge_shards(args.merge)
+        finally:
+            release_tags_lock(lock_path)
+        for line in conflicts:
+            print(f"CONFLICT {line}")
+        for line in unreadable:
+            print(f"UNREADABLE {line}")
+        print(f"Merged {n_pairs} pairs, {len(conflicts)} conflicts, {len(unreadable)} unreadable files.")
+        sys.exit(1 if conflicts or unreadable else 0)
+
+    shard = None
+    if args.shard is not None:
+        from shards import parse_shard_spec
+
+        shard_status, shard = parse_shard_spec(args.shard)
+        if not shard_status:
+            parser.error(shard)
+        if args.annotator is None:
+            parser.error("--shard requires --annotator, so that shards do not share a tags file.")
+
     # args.tiny_window = True
     # args.small_window = True
 
@@ -30,4 +119,4 @@ if "__main__" == __name__:
 
     from image_tagging_tool import ImageTaggingTool
 
-    ImageTaggingTool(args.small_window, args.tiny_window)
+    ImageTaggingTool(args.small_window, args.tiny_window, args.max_edge, args.annotator, shard, args.record_trace)
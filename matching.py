@@ -0,0 +1,105 @@
+from __future__ import annotations
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from PIL import Image
+
+from constants import FEATURE_MAX_EDGE, FEATURE_COUNT, FEATURE_SNAP_RADIUS, FEATURE_MIN_SCORE, FEATURE_RATIO
+from utils import open_overviews, pick_overview
+
+# Descriptors are 8x8 samples, 2 pixels apart, of the smoothed image around each keypoint
+PATCH_RADIUS = 8
+PATCH_STEP = 2
+HARRIS_K = 0.05
+HARRIS_MIN = 1e-12  # responses below are rounding noise of the summed-area tables, flat areas have no corners
+
+FeaturesType = tuple[np.ndarray, np.ndarray, float]  # keypoints in original pixels, descriptors, working scale
+
+
+def _box_blur(a: np.ndarray, radius: int) -> np.ndarray:
+    """ Mean over a (2 * radius + 1) square window, from a summed-area table. """
+    size = 2 * radius + 1
+    padded = np.pad(a, radius + 1, mode="edge")
+    table = padded.cumsum(axis=0).cumsum(axis=1)
+    h, w = a.shape
+    window = (table[size:size + h, size:size + w] - table[:h, size:size + w]
+              - table[size:size + h, :w] + table[:h, :w])
+    return window / (size * size)
+
+
+def _no_features(scale: float) -> FeaturesType:
+    """ For flat or tiny images, suggest_match then never proposes anything. """
+    descriptor_size = (2 * PATCH_RADIUS // PATCH_STEP) ** 2
+    return np.empty((0, 2), np.float32), np.empty((0, descriptor_size), np.float32), scale
+
+
+def detect_features(path: str) -> FeaturesType:
+    """ Harris corners with normalized patch descriptors, computed on a reduced grayscale copy of the image. """
+    overviews = open_overviews(path)
+    orig_w = overviews[0][1].width
+    image, _ = pick_overview(overviews, FEATURE_MAX_EDGE / max(overviews[0][1].size))
+    image.draft("L", (FEATURE_MAX_EDGE, FEATURE_MAX_EDGE))
+    image = image.convert("L")
+    image.thumbnail((FEATURE_MAX_EDGE, FEATURE_MAX_EDGE), Image.Resampling.BILINEAR)
+    scale = image.width / orig_w
+    if min(image.size) <= 2 * PATCH_RADIUS:
+        return _no_features(scale)  # no patch fits away from the border
+
+    gray = _box_blur(np.asarray(image, dtype=np.float32) / 255, 1)
+    grad_y, grad_x = np.gradient(gray)
+    sxx = _box_blur(grad_x * grad_x, 2)
+    syy = _box_blur(grad_y * grad_y, 2)
+    sxy = _box_blur(grad_x * grad_y, 2)
+    response = sxx * syy - sxy * sxy - HARRIS_K * (sxx + syy) ** 2
+
+    # keep local maxima away from the border, strongest first
+    local_max = sliding_window_view(np.pad(response, 2, constant_values=-np.inf), (5, 5)).max(axis=(2, 3))
+    candidates = (response == local_max) & (response > HARRIS_MIN)
+    candidates[:PATCH_RADIUS, :] = candidates[-PATCH_RADIUS:, :] = False
+    candidates[:, :PATCH_RADIUS] = candidates[:, -PATCH_RADIUS:] = False
+    ys, xs = np.nonzero(candidates)
+    if not len(ys):
+        return _no_features(scale)
+
+    strongest = np.argsort(response[ys, xs])[::-1][:FEATURE_COUNT]
+    ys, xs = ys[strongest], xs[strongest]
+
+    offsets = np.arange(-PATCH_RADIUS, PATCH_RADIUS, PATCH_STEP)
+    patches = gray[ys[:, None, None] + offsets[None, :, None], xs[:, None, None] + offsets[None, None, :]]
+    descriptors = patches.reshape(len(ys), -1)
+    descriptors -= descriptors.mean(axis=1, keepdims=True)
+    descriptors /= np.linalg.norm(descriptors, axis=1, keepdims=True) + 1e-6
+
+    keypoints = np.stack([xs, ys], axis=1).astype(np.float32) / scale
+    return keypoints, descriptors.astype(np.float32), scale
+
+
+def compute_pair_features(img0_path: str, img1_path: str) -> tuple[FeaturesType, FeaturesType]:
+    return detect_features(img0_path), detect_features(img1_path)
+
+
+def suggest_match(source: FeaturesType, target: FeaturesType,
+                  point: tuple[float, float]) -> tuple[float, float] | None:
+    """
+    Propose the point in the target image that corresponds to point in the source image: the clicked point is
+    snapped to its nearest source keypoint, which is matched by descriptor correlation with a ratio test.
+    Returns None when there is no keypoint near the click or no unambiguous match.
+    """
+    src_keypoints, src_descriptors, src_scale = source
+    dst_keypoints, dst_descriptors, _ = target
+    if not len(src_keypoints) or len(dst_keypoints) < 2:
+        return None
+
+    click = np.array(point, dtype=np.float32)
+    dists = np.linalg.norm(src_keypoints - click, axis=1)
+    nearest = int(np.argmin(dists))
+    if dists[nearest] > FEATURE_SNAP_RADIUS / src_scale:
+        return None
+
+    scores = dst_descriptors @ src_descriptors[nearest]
+    second, best = np.argpartition(scores, -2)[-2:]
+    if scores[best] < FEATURE_MIN_SCORE or scores[second] > FEATURE_RATIO * scores[best]:
+        return None
+
+    x, y = dst_keypoints[best] + (click - src_keypoints[nearest])
+    return float(x), float(y)
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import html
+import multiprocessing
+import os
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+
+from constants import MAX_COLORS, OVERLAY_QUALITY, OVERLAY_CHUNK
+from utils import generate_rainbow_colors, format_tag, get_tag_name_convention, read_tags_file, make_pairs, \
+    scan_image_files, open_overviews, pick_overview
+
+OverlayJobType = tuple[str, str, str, list, tuple[int, int], bool]  # img0, img1, out path, points, size, lines
+
+
+def load_reduced(path: str, max_w: int, max_h: int):
+    """ Decode path no larger than needed to fit in max_w x max_h. Returns the image and its scale. """
+    from PIL import Image
+
+    overviews = open_overviews(path)
+    orig_w, orig_h = overviews[0][1].size
+    scale = min(max_w / orig_w, max_h / orig_h, 1)
+    size = (max(1, round(orig_w * scale)), max(1, round(orig_h * scale)))
+    image, _ = pick_overview(overviews, scale)
+    image.draft("RGB", size)
+    image = image.convert("RGB")
+    if image.size != size:
+        image = image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0)
+    return image, size[0] / orig_w
+
+
+def render_overlay(img0_path: str, img1_path: str, points: list, size: tuple[int, int], lines: bool):
+    """ Both images side by side in size, with the pair's points numbered and coloured as in the tool. """
+    from PIL import Image, ImageDraw, ImageFont
+
+    width, height = size
+    image0, scale0 = load_reduced(img0_path, width // 2, height)
+    image1, scale1 = load_reduced(img1_path, width // 2, height)
+    sheet = Image.new("RGB", (image0.width + image1.width, max(image0.height, image1.height)))
+    sheet.paste(image0, (0, 0))
+    sheet.paste(image1, (image0.width, 0))
+
+    draw = ImageDraw.Draw(sheet)
+    colors = generate_rainbow_colors(MAX_COLORS)
+    radius = max(3, sheet.height // 150)
+    font = ImageFont.load_default(size=3 * radius + 2)
+    for idx, ((x0, y0), (x1, y1)) in enumerate(points):
+        color = colors[idx % MAX_COLORS]
+        p0 = (x0 * scale0, y0 * scale0)
+        p1 = (x1 * scale1 + image0.width, y1 * scale1)
+        if lines:
+            draw.line((p0, p1), fill=color, width=1)
+
+        label = str(idx + 1)  # numbered as in the tag list, see format_tag
+        for x, y in (p0, p1):
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius), fill=color, outline="#000000")
+            draw.text((x + radius + 1, y - radius), label, fill=color, font=font, stroke_width=1, stroke_fill="#000000")
+
+    return sheet
+
+
+def render_overlay_file(job: OverlayJobType) -> tuple[bool, str]:
+    """ Worker side: render one pair and write it, so only its path travels back. """
+    from PIL import Image
+
+    img0_path, img1_path, out_path, points, size, lines = job
+    try:
+        render_overlay(img0_path, img1_path, points, size, lines).save(out_path, quality=OVERLAY_QUALITY)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        return False, f"{os.path.basename(img0_path)}: {e}"
+
+    return True, out_path
+
+
+def plan_overlays(data_dir: str, out_dir: str, size: tuple[int, int],
+                  lines: bool) -> tuple[bool, str | list[OverlayJobType]]:
+    tags_status, tags_result = read_tags_file(os.path.join(data_dir, get_tag_name_convention(data_dir)))
+    if not tags_status:
+        return False, tags_result
+
+    pairs_status, pairs_result = make_pairs(sorted(scan_image_files(data_dir)))
+    if not pairs_status:
+        return False, pairs_result
+
+    all_tags = tags_result.get("all_tags", {})
+    jobs = []
+    for idx, (img0, img1) in enumerate(pairs_result):
+        base_img_name = os.path.splitext(img0)[0][:-2]
+        out_path = os.path.join(out_dir, f"{idx:06d}_{base_img_name}.jpg")  # sorts in the tool's pair order
+        jobs.append((os.path.join(data_dir, img0), os.path.join(data_dir, img1), out_path,
+                     all_tags.get(base_img_name, []), size, lines))
+
+    return True, jobs
+
+
+def export_overlays(jobs: list[OverlayJobType], out_dir: str, workers: int | None = None) -> Iterator[tuple[bool, str]]:
+    """
+    Render the jobs in worker processes, writing each overlay as it is done, and an index.html contact sheet of
+    them in pair order. Yields the status of every pair as it completes.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool, \
+            open(os.path.join(out_dir, "index.html"), "w") as index:
+        index.write("<!DOCTYPE html><html><head><style>body {background: #222; color: #ddd; font: 12px sans-serif} "
+                    "figure {display: inline-block; margin: 4px} img {max-width: 31vw}</style></head><body>\n")
+        for job, (status, result) in zip(jobs, pool.map(render_overlay_file, jobs, chunksize=OVERLAY_CHUNK)):
+            if status:
+                _, _, out_path, points, _, _ = job
+                name = html.escape(os.path.basename(out_path))
+                tags = html.escape("\n".join(format_tag(p0, p1, idx) for idx, (p0, p1) in enumerate(points)))
+                index.write(f"<figure><img src='{name}' loading='lazy' title='{tags}'>"
+                            f"<figcaption>{name}, {len(points)} tags</figcaption></figure>\n")
+            yield status, result
+
+        index.write("</body></html>\n")
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import json
+import os
+
+from constants import __VERSION__, SESSION_DIR
+
+SESSION_FILE = "session.json"
+
+
+def get_session_path(name: str = SESSION_FILE) -> str:
+    return os.path.join(os.path.expanduser(SESSION_DIR), name)
+
+
+def get_preview_path(canvas_idx: int) -> str:
+    return get_session_path(f"preview{canvas_idx}.png")
+
+
+def read_session() -> dict | None:
+    """ Return the last session snapshot, or None if there is no usable one. """
+    path = get_session_path()
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with open(path, "r") as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if snapshot.get("version") != __VERSION__ or not os.path.isdir(snapshot.get("data_dir", "")):
+        return None
+
+    return snapshot
+
+
+def ensure_session_dir():
+    os.makedirs(os.path.expanduser(SESSION_DIR), exist_ok=True)
+
+
+def write_session(snapshot: dict):
+    ensure_session_dir()
+    path = get_session_path()
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({"version": __VERSION__, **snapshot}, f)
+    os.replace(f"{path}.tmp", path)
@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+import glob
+import json
+import os
+import socket
+import zlib
+
+from utils import get_tag_name_convention
+
+
+def get_shard_tag_name(path: str, annotator: str) -> str:
+    """ Per-annotator tags file, next to the canonical tags_<dir>_.json of the same directory. """
+    return f"tags_{os.path.split(path)[-1]}_{annotator}_.json"
+
+
+def parse_shard_spec(spec: str) -> tuple[bool, str | tuple[str, int, int]]:
+    """ Parse 'range:START:END' (pair indices, END exclusive) or 'hash:K/N' (K-th of N hash partitions). """
+    kind, _, value = spec.partition(":")
+    try:
+        if kind == "range":
+            start, end = map(int, value.split(":"))
+        elif kind == "hash":
+            start, end = map(int, value.split("/"))
+        else:
+            return False, f"Unknown shard type '{kind}', use range:START:END or hash:K/N."
+    except ValueError:
+        return False, f"Badly formatted shard '{spec}', use range:START:END or hash:K/N."
+
+    if kind == "range" and not 0 <= start < end:
+        return False, "Shard range must satisfy 0 <= START < END."
+    if kind == "hash" and not 0 <= start < end:
+        return False, "Hash shard must satisfy 0 <= K < N."
+
+    return True, (kind, start, end)
+
+
+def in_shard(idx: int, base_name: str, shard: tuple[str, int, int]) -> bool:
+    kind, start, end = shard
+    if kind == "range":
+        return start <= idx < end
+    else:
+        # crc32 rather than hash() so that every machine agrees on the partition
+        return zlib.crc32(base_name.encode()) % end == start
+
+
+def select_shard(pairs: list[tuple[str, str]],
+                 shard: tuple[str, int, int] | None) -> tuple[bool, str | list[tuple[str, str]]]:
+    if shard is None:
+        return True, pairs
+
+    selected = [(img0, img1) for idx, (img0, img1) in enumerate(pairs)
+                if in_shard(idx, os.path.splitext(img0)[0][:-2], shard)]
+    if not selected:
+        return False, "The selected shard has no image pairs in this folder."
+
+    return True, selected
+
+
+def in_shard_by_name(base_name: str, shard: tuple[str, int, int] | None) -> bool:
+    """ For pairs that appear after the folder was opened: hash shards take them, range shards never do. """
+    if shard is None:
+        return True
+
+    kind, _, _ = shard
+    return kind == "hash" and in_shard(-1, base_name, shard)
+
+
+def is_process_alive(pid: int) -> bool:
+    if os.name == "nt":
+        import ctypes
+
+        # PROCESS_QUERY_LIMITED_INFORMATION, fails for pids that no longer exist
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # exists, owned by another user
+
+    return True
+
+
+def is_stale_lock(holder: str) -> bool:
+    """ A lock left behind by a crashed session. Only decidable for sessions of this host. """
+    host, _, pid = holder.rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+
+    return int(pid) != os.getpid() and not is_process_alive(int(pid))
+
+
+def acquire_tags_lock(tags_path: str) -> tuple[bool, str]:
+    """
+    Advisory lock: a .lock file next to the tags file, holding the owner's host and pid.
+    A lock whose owner ran on this host and is gone is taken over.
+    """
+    lock_path = f"{tags_path}.lock"
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        with open(lock_path, "r") as f:
+            holder = f.read().strip()
+        if not is_stale_lock(holder):
+            return False, f"{os.path.basename(tags_path)} is in use by {holder}.\n" \
+                          f"If that session is gone, delete {os.path.basename(lock_path)}."
+
+        os.remove(lock_path)
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False, f"{os.path.basename(tags_path)} was just locked by another session."
+
+    with os.fdopen(fd, "w") as f:
+        f.write(owner)
+
+    return True, lock_path
+
+
+def release_tags_lock(lock_path: str | None):
+    if lock_path is not None and os.path.isfile(lock_path):
+        os.remove(lock_path)
+
+
+def find_shard_files(data_dir: str) -> list[str]:
+    canonical = get_tag_name_convention(data_dir)
+    pattern = os.path.join(glob.escape(data_dir), f"tags_{glob.escape(os.path.split(data_dir)[-1])}_*_.json")
+    return sorted(path for path in glob.glob(pattern) if os.path.basename(path) != canonical)
+
+
+def merge_shards(data_dir: str) -> tuple[int, list[str], list[str]]:
+    """
+    Stream every shard tags file of data_dir into the canonical tags file.
+    Shards win over the existing canonical file. When several shards tagged the same pair differently, the first
+    shard (by name) is kept and the conflict is reported. An empty tag list is a value like any other: the tool only
+    stores one for a pair whose tags were all deleted, so it overrides stale tags of the canonical file.
+    Unreadable shards are skipped and reported. An unreadable canonical file is left as it is, nothing is merged.
+    Returns the number of merged pairs, the conflict report lines and the unreadable files report lines.
+    """
+    canonical_path = os.path.join(data_dir, get_tag_name_convention(data_dir))
+    sources = find_shard_files(data_dir)
+    if os.path.isfile(canonical_path):
+        sources.append(canonical_path)
+
+    owners: dict[str, tuple[str, int]] = {}  # pair -> (source file, crc of its tags), so tags are not held
+    conflicts = []
+    unreadable = []
+    open_pair_name = ""
+    tmp_path = f"{canonical_path}.tmp"
+    try:
+        with open(tmp_path, "w") as out:
+            out.write('{"all_tags": {')
+            for path in sources:
+                source_name = os.path.basename(path)
+                try:
+                    with open(path, "r") as f:
+                        payload = json.load(f)
+                    if not isinstance(payload, dict):
+                        raise ValueError("not a tags file")
+                except (OSError, ValueError) as e:
+                    if path == canonical_path:
+                        unreadable.append(f"{source_name}: unreadable, left as it is and nothing merged ({e})")
+                        return 0, conflicts, unreadable
+                    unreadable.append(f"{source_name}: unreadable, skipped ({e})")
+                    continue
+
+                open_pair_name = open_pair_name or payload.get("open_pair_name", "")
+                for pair, points in payload.get("all_tags", {}).items():
+                    encoded = json.dumps(points)
+                    crc = zlib.crc32(encoded.encode())
+                    if pair in owners:
+                        owner, owner_crc = owners[pair]
+                        if owner_crc != crc and path != canonical_path:
+                            conflicts.append(f"{pair}: {source_name} differs from {owner}, keeping {owner}")
+                        continue
+
+                    out.write(f'{", " if owners else ""}{json.dumps(pair)}: {encoded}')
+                    owners[pair] = (source_name, crc)
+
+                del payload
+
+            out.write(f'}}, "open_pair_name": {json.dumps(open_pair_name)}, "timestamp": ""}}')
+
+        os.replace(tmp_path, canonical_path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+    return len(owners), conflicts, unreadable
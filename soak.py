@@ -0,0 +1,444 @@
+"""
+Long-session memory soak: pages through pairs with random zooms, pans and tag edits, recording RSS, traced Python
+memory, live Tk images and canvas items per iteration. Fails when memory keeps growing after the warm-up.
+
+With a display (or Xvfb, started automatically when there is none) the real ImageTaggingTool is driven through its
+event handlers. Otherwise the same hot paths run on stubbed canvases and photo images.
+Tags are never saved: without --data-dir a synthetic dataset is generated in a temporary folder.
+
+    python soak.py --iterations 300 --max-growth-mb 50 --report soak.csv
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import weakref
+from types import SimpleNamespace
+
+from constants import IMG_SCALES, MAX_COLORS, IMG_FILES
+
+
+def get_rss_mb() -> float | None:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def make_dataset(data_dir: str, n_pairs: int, size: tuple[int, int]):
+    from PIL import Image
+
+    for idx in range(n_pairs):
+        for suffix in ("_1", "_2"):
+            image = Image.effect_noise(size, 40 + idx % 50).convert("RGB")
+            image.save(os.path.join(data_dir, f"pair{idx:04d}{suffix}.jpg"))
+
+
+def start_xvfb() -> subprocess.Popen | None:
+    """ Start a virtual framebuffer when there is no display, if Xvfb is installed. """
+    if os.environ.get("DISPLAY") or sys.platform.startswith("win") or shutil.which("Xvfb") is None:
+        return None
+
+    display = ":97"
+    xvfb = subprocess.Popen(["Xvfb", display, "-screen", "0", "1920x1200x24"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1)
+    os.environ["DISPLAY"] = display
+    return xvfb
+
+
+def has_display() -> bool:
+    import tkinter as tk
+
+    try:
+        tk.Tk().destroy()
+        return True
+    except tk.TclError:
+        return False
+
+
+class StubPhotoImage:
+    """ Stands in for ImageTk.PhotoImage without Tk, keeping the PIL image alive the way Tk keeps its pixels. """
+    live = weakref.WeakSet()
+
+    def __init__(self, image):
+        self.pil_image = image.copy()
+        StubPhotoImage.live.add(self)
+
+    def width(self):
+        return self.pil_image.width
+
+    def height(self):
+        return self.pil_image.height
+
+
+class StubWidget:
+    def configure(self, **kwargs):
+        pass
+
+    def cget(self, key):
+        return ""
+
+
+class StubCanvas:
+    """ The subset of tk.Canvas used by the drawing code, over a dict of items. """
+
+    def __init__(self, width: int, height: int):
+        # same state as utils.Canvas
+        self.points = []
+        self.image = None
+        self.temp_point = None
+        self.suggested = False
+        self.tag_text = StubWidget()
+        self.master = StubWidget()
+        self.twin = None
+        self.selected_tag_idx = None
+        self.zoom_scale = 1
+        self.scale_idx = IMG_SCALES.index(1)
+        self.scaled_images = None
+        self.path = None
+        self.working = None
+        self.shared = []
+        self.source_size = (0, 0)
+        self.source_scale = 1
+        self.image_size = (0, 0)
+        self.image_offset = (0, 0)
+        self.refined = None
+        self.refine_generation = 0
+        self.width, self.height = width, height
+        self.items: dict[int, tuple[str, list[float]]] = {}
+        self.next_item = 0
+
+    def _create(self, tag: str, coords: list[float]) -> int:
+        self.next_item += 1
+        self.items[self.next_item] = (tag, coords)
+        return self.next_item
+
+    def create_image(self, x, y, anchor=None, image=None, tags=""):
+        return self._create(tags, [x, y])
+
+    def create_oval(self, x1, y1, x2, y2, tags="", **kwargs):
+        return self._create(tags, [x1, y1, x2, y2])
+
+    def delete(self, tag):
+        self.items = {idx: item for idx, item in self.items.items() if item[0] != tag}
+
+    def coords(self, tag):
+        return next(list(coords) for item_tag, coords in self.items.values() if item_tag == tag)
+
+    def move(self, tag, dx, dy):
+        for item_tag, coords in self.items.values():
+            if item_tag == tag:
+                coords[0::2] = [x + dx for x in coords[0::2]]
+                coords[1::2] = [y + dy for y in coords[1::2]]
+
+    def config(self, **kwargs):
+        pass
+
+    def cget(self, key):
+        return {"width": self.width, "height": self.height}[key]
+
+    def canvasx(self, x):
+        return x
+
+    def canvasy(self, y):
+        return y
+
+    def tag_raise(self, *args):
+        pass
+
+    def find_all(self):
+        return tuple(self.items)
+
+
+def random_canvas_point(canvas) -> tuple[int, int]:
+    return random.randrange(int(canvas.cget("width"))), random.randrange(int(canvas.cget("height")))
+
+
+class TkDriver:
+    """ Drives the real tool through its event handlers. """
+
+    def __init__(self, data_dir: str, max_edge: int | None, idle_ms: int):
+        from image_tagging_tool import ImageTaggingTool
+
+        self.idle_ms = idle_ms
+        self.tool = ImageTaggingTool(False, False, max_edge, run=False)
+        self.tool.debug = True
+        self.tool.save_tags = lambda: None  # the soak never writes tags
+        pairs_status, pairs = self.tool._scan_pairs(data_dir)
+        if not pairs_status or not self.tool.open_data_dir(data_dir, pairs):
+            raise RuntimeError(f"Cannot open {data_dir}: {pairs}")
+        self.wait_loaded()
+
+    def process_events(self, duration_ms: int = 0):
+        deadline = time.perf_counter() + duration_ms / 1000
+        self.tool.root.update()
+        while time.perf_counter() < deadline:
+            time.sleep(0.01)
+            self.tool.root.update()
+
+    def wait_loaded(self):
+        """ Pairs are decoded in worker processes, run the event loop until the current one is shown. """
+        while self.tool.decode_jobs:
+            self.process_events(10)
+
+    def step(self, n_zooms: int, n_pans: int, n_edits: int):
+        tool = self.tool
+        curr_idx = tool.reverse_file_index[tool.current_pair]
+        if curr_idx + 1 < len(tool.file_index):
+            tool.next_pair()
+        else:
+            tool.load_selected_pair(name=tool.file_index[0])
+        self.wait_loaded()
+
+        for canvas in (tool.canvas0, tool.canvas1):
+            for _ in range(n_zooms):
+                x, y = random_canvas_point(canvas)
+                event = SimpleNamespace(widget=canvas, x=x, y=y, delta=random.choice((-120, 120)))
+                tool.zoom(event)
+                self.process_events()
+
+            tool.tag_mode = False
+            for _ in range(n_pans):
+                x, y = random_canvas_point(canvas)
+                tool.on_canvas_click(SimpleNamespace(widget=canvas, x=x, y=y))
+                tool.pan_image(SimpleNamespace(widget=canvas, x=x + random.randint(-200, 200),
+                                               y=y + random.randint(-200, 200)))
+                self.process_events()
+            tool.tag_mode = True
+
+        for _ in range(n_edits):
+            if tool.points and random.random() < 0.3:
+                tool.tag_list.selection_clear(0, "end")
+                tool.tag_list.selection_set(random.randrange(len(tool.points)))
+                tool.delete_tag(SimpleNamespace(widget=tool.tag_list))
+            else:
+                for canvas in (tool.canvas0, tool.canvas1):
+                    x, y = random_canvas_point(canvas)
+                    tool.on_canvas_click(SimpleNamespace(widget=canvas, x=x, y=y))
+                tool.confirm_tag(None)
+            self.process_events()
+
+        self.process_events(self.idle_ms)  # let idle refinement and background work land
+
+    def tk_image_count(self) -> int:
+        return len(self.tool.root.tk.call("image", "names"))
+
+    def canvas_item_count(self) -> int:
+        return len(self.tool.canvas0.find_all()) + len(self.tool.canvas1.find_all())
+
+    def close(self):
+        self.tool.shutdown()
+        self.tool.root.destroy()
+
+
+class StubDriver:
+    """ Runs the same loading, zoom, pan, refine and redraw code paths on stubbed canvases, without Tk. """
+
+    def __init__(self, data_dir: str, max_edge: int | None, canvas_size: tuple[int, int]):
+        import PIL.ImageTk
+        from image_tagging_tool import ImageTaggingTool
+        from utils import make_pairs, generate_rainbow_colors
+
+        PIL.ImageTk.PhotoImage = StubPhotoImage
+        self.redraw_points = ImageTaggingTool.redraw_points
+        self.tool = SimpleNamespace(colors=generate_rainbow_colors(MAX_COLORS))
+        self.max_edge = max_edge
+        files = [name for name in os.listdir(data_dir) if name.lower().endswith(IMG_FILES)]
+        pairs_status, pairs = make_pairs(files)
+        if not pairs_status:
+            raise RuntimeError(f"Cannot open {data_dir}: {pairs}")
+        self.pairs = [(os.path.join(data_dir, img0), os.path.join(data_dir, img1)) for img0, img1 in pairs]
+        self.pair_idx = -1
+        self.busy_segments = []
+        self.canvases = (StubCanvas(*canvas_size), StubCanvas(*canvas_size))
+        self.canvases[0].twin, self.canvases[1].twin = self.canvases[1], self.canvases[0]
+
+    def step(self, n_zooms: int, n_pans: int, n_edits: int):
+        from decoding import plan_decode, decode_into, load_shared_images, release_segments
+        from utils import show_zoom_level, apply_image_scaling, refresh_region, image_origin, get_visible_region, \
+            get_refine_job, get_start_zoom_idx, put_refined_on_canvas, reset_canvases
+
+        self.pair_idx = (self.pair_idx + 1) % len(self.pairs)
+        canvas0, canvas1 = self.canvases
+        reset_canvases(canvas0=canvas0, canvas1=canvas1, points=[])
+        for canvas, path in zip(self.canvases, self.pairs[self.pair_idx]):
+            # the tool decodes in worker processes, here the same shared memory handoff runs in-process
+            plan_status, plan_result = plan_decode(path, self.max_edge, IMG_SCALES)
+            if not plan_status:
+                raise RuntimeError(plan_result)
+            segments, spec = plan_result
+            decode_into(path, spec)
+            self.busy_segments = release_segments(self.busy_segments + load_shared_images(canvas, path, segments, spec))
+            show_zoom_level(canvas, (0, 0))
+            canvas.scale_idx = get_start_zoom_idx(canvas)
+            apply_image_scaling(canvas, (0, 0))
+
+            for _ in range(n_zooms):
+                canvas.scale_idx = min(max(canvas.scale_idx + random.choice((-1, 1)), 0), len(IMG_SCALES) - 1)
+                apply_image_scaling(canvas, random_canvas_point(canvas))
+                self.redraw_points(self.tool, canvas)
+
+            for _ in range(n_pans):
+                canvas.move("image", random.randint(-200, 200), random.randint(-200, 200))
+                refresh_region(canvas)
+                self.redraw_points(self.tool, canvas)
+
+            origin = image_origin(canvas)
+            region = get_visible_region(canvas, origin)
+            refine, *args = get_refine_job(canvas, region)
+            refined = refine(*args)
+            put_refined_on_canvas(canvas, StubPhotoImage(refined), (origin[0] + region[0], origin[1] + region[1]))
+
+        for _ in range(n_edits):
+            if canvas0.points and random.random() < 0.3:
+                idx = random.randrange(len(canvas0.points))
+                canvas0.points.pop(idx)
+                canvas1.points.pop(idx)
+            else:
+                canvas0.points.append((random.uniform(0, 100), random.uniform(0, 100)))
+                canvas1.points.append((random.uniform(0, 100), random.uniform(0, 100)))
+            self.redraw_points(self.tool, canvas0)
+            self.redraw_points(self.tool, canvas1)
+
+    def tk_image_count(self) -> int:
+        return len(StubPhotoImage.live)
+
+    def canvas_item_count(self) -> int:
+        return sum(len(canvas.find_all()) for canvas in self.canvases)
+
+    def close(self):
+        from decoding import release_segments
+
+        for canvas in self.canvases:
+            canvas.working = None
+            release_segments(canvas.shared)
+
+
+def take_snapshot() -> tracemalloc.Snapshot:
+    """ A tracemalloc snapshot without tracemalloc's own allocations, which the snapshots themselves cause. """
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def format_top_allocators(snapshot: tracemalloc.Snapshot, previous: tracemalloc.Snapshot, top: int) -> str:
+    """ The lines that allocated the most since the previous snapshot, as 'file:line +size' separated by '; '. """
+    stats = snapshot.compare_to(previous, "lineno")[:top]
+    return "; ".join(f"{stat.traceback[0]} {stat.size_diff / 1024:+.1f} KiB" for stat in stats)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", default=None, help="Dataset to page through, a synthetic one is made if omitted.")
+    parser.add_argument("--pairs", type=int, default=8, help="Pairs in the synthetic dataset.")
+    parser.add_argument("--image-size", type=int, nargs=2, default=(1600, 1200), help="Synthetic image size.")
+    parser.add_argument("--iterations", type=int, default=100, help="Pairs to page through.")
+    parser.add_argument("--warmup", type=int, default=10, help="Iterations before the baseline is taken.")
+    parser.add_argument("--zooms", type=int, default=6, help="Random zooms per canvas per iteration.")
+    parser.add_argument("--pans", type=int, default=4, help="Random pans per canvas per iteration.")
+    parser.add_argument("--edits", type=int, default=4, help="Random tag additions/deletions per iteration.")
+    parser.add_argument("--idle-ms", type=int, default=300, help="Idle time per iteration, for refinement.")
+    parser.add_argument("--max-edge", type=int, default=None, help="Run in working-resolution mode.")
+    parser.add_argument("--max-growth-mb", type=float, default=50, help="Allowed RSS growth after the warm-up.")
+    parser.add_argument("--max-image-growth", type=int, default=4, help="Allowed growth in live Tk images.")
+    parser.add_argument("--stub", action="store_true", help="Use stubbed canvases even if a display is available.")
+    parser.add_argument("--report", default=None, help="Write the per-iteration measurements to this CSV file.")
+    parser.add_argument("--top", type=int, default=3, help="Top allocators reported per iteration.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    tmp_dir = None
+    data_dir = args.data_dir
+    if data_dir is None:
+        tmp_dir = tempfile.mkdtemp(prefix="soak_")
+        data_dir = os.path.join(tmp_dir, "soak")
+        os.makedirs(data_dir)
+        make_dataset(data_dir, args.pairs, tuple(args.image_size))
+
+    xvfb = None if args.stub else start_xvfb()
+    if not args.stub and has_display():
+        driver = TkDriver(data_dir, args.max_edge, args.idle_ms)
+        mode = "tk"
+    else:
+        driver = StubDriver(data_dir, args.max_edge, (800, 800))
+        mode = "stub"
+    print(f"Soak in {mode} mode, {args.iterations} iterations over {data_dir}")
+
+    tracemalloc.start(10)
+    rows = []
+    baseline = None
+    previous = take_snapshot()
+    try:
+        for iteration in range(args.iterations):
+            start = time.perf_counter()
+            driver.step(args.zooms, args.pans, args.edits)
+            seconds = time.perf_counter() - start
+            traced, _ = tracemalloc.get_traced_memory()
+            snapshot = take_snapshot()
+            rows.append({"iteration": iteration,
+                         "seconds": round(seconds, 4),
+                         "rss_mb": get_rss_mb(),
+                         "traced_mb": traced / 2 ** 20,
+                         "tk_images": driver.tk_image_count(),
+                         "canvas_items": driver.canvas_item_count(),
+                         "top_allocators": format_top_allocators(snapshot, previous, args.top)})
+            previous = snapshot
+            if iteration + 1 == args.warmup:
+                baseline = snapshot
+    finally:
+        driver.close()
+        if xvfb is not None:
+            xvfb.terminate()
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    if args.report is not None:
+        with open(args.report, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+    if baseline is None:
+        print("Not enough iterations after the warm-up to judge growth.")
+        return 0
+
+    print("Top allocators since the warm-up:")
+    for stat in take_snapshot().compare_to(baseline, "lineno")[:10]:
+        print(f"  {stat}")
+
+    print("Top allocators per iteration after the warm-up, see --report for all:")
+    for row in rows[args.warmup:]:
+        print(f"  {row['iteration']:>5}  {row['top_allocators']}")
+
+    first, last = rows[args.warmup - 1], rows[-1]
+    failures = []
+    if first["rss_mb"] is not None and last["rss_mb"] - first["rss_mb"] > args.max_growth_mb:
+        failures.append(f"RSS grew {last['rss_mb'] - first['rss_mb']:.1f} MB")
+    if last["traced_mb"] - first["traced_mb"] > args.max_growth_mb:
+        failures.append(f"traced Python memory grew {last['traced_mb'] - first['traced_mb']:.1f} MB")
+    if last["tk_images"] - first["tk_images"] > args.max_image_growth:
+        failures.append(f"live Tk images grew from {first['tk_images']} to {last['tk_images']}")
+
+    for key in ("rss_mb", "traced_mb", "tk_images", "canvas_items"):
+        if first[key] is not None:
+            print(f"{key}: {first[key]:.1f} -> {last[key]:.1f}")
+
+    if failures:
+        print(f"FAIL: {', '.join(failures)}")
+        return 1
+
+    print("PASS")
+    return 0
+
+
+if "__main__" == __name__:
+    sys.exit(main())
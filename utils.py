@@ -2,11 +2,17 @@ from __future__ import annotations
 import colorsys
 import os.path
 import tkinter as tk
-from collections import Counter
-from PIL import Image, ImageTk, ImageFile
+from collections import Counter, OrderedDict
+from typing import TYPE_CHECKING
 import json
+from binary_tags import is_binary_tags_file, read_binary_tags
 from constants import IMG_SCALES, IMG_FILES, NEUTRAL_ZOOM_IDX, PT_BASE_SIZE, PT_ZOOM_SCALE_FACTOR, PT_MINIMUM_SIZE, \
-    PT_SELECTED_EXTRA_SIZE
+    PT_SELECTED_EXTRA_SIZE, RESAMPLE_FAST, RESAMPLE_FINE, MAX_IMAGE_PIXELS, REFINE_CACHE_SIZE
+
+# PIL is imported where it is used, so that the window can come up before it is loaded
+if TYPE_CHECKING:
+    from collections.abc import Callable
+    from PIL import Image, ImageTk, ImageFile
 
 
 class Canvas(tk.Canvas):
@@ -15,12 +21,24 @@ class Canvas(tk.Canvas):
         self.points = []
         self.image = None
         self.temp_point = None
+        self.suggested = False  # temp_point was proposed by the matcher rather than clicked
         self.tag_text = None
         self.twin = None
         self.selected_tag_idx = None
         self.zoom_scale = 1
         self.scale_idx = NEUTRAL_ZOOM_IDX
         self.scaled_images = None
+        self.path = None  # original file, zoom levels beyond the working image are decoded from it off the UI thread
+        self.working = None  # capped-resolution image in working-resolution mode, else the original itself
+        self.shared = []  # shared memory segments behind working, when it was decoded by a worker process
+        self.source_size = (0, 0)  # original image size, tags are always in these coordinates
+        self.source_scale = 1  # working image pixels per original pixel
+        self.image_size = (0, 0)  # full size of the current zoom level
+        self.image_offset = (0, 0)  # top-left of the displayed region inside the current zoom level
+        self.refined = None  # idle-time high-quality overlay of the visible region
+        self.refine_id = None
+        self.refine_future = None
+        self.refine_generation = 0  # bumped whenever the view changes, refinements queued before it are stale
 
 
 def get_tag_name_convention(path: str) -> str:
@@ -29,8 +47,11 @@ def get_tag_name_convention(path: str) -> str:
 
 def read_tags_file(path: str) -> tuple[bool, dict | str]:
     if os.path.isfile(path):
-        with open(path, "r") as f:
-            payload = json.load(f)
+        if is_binary_tags_file(path):
+            payload = read_binary_tags(path)
+        else:
+            with open(path, "r") as f:
+                payload = json.load(f)
 
         if "all_tags" in payload:
             return True, payload
@@ -64,6 +85,36 @@ def make_pairs(file_names: list[str]) -> tuple[bool, str | list[tuple[str, str]]
     return True, [(sorted_names[i], sorted_names[i + 1]) for i in range(0, len(sorted_names), 2)]
 
 
+def scan_image_files(image_dir: str) -> set[str]:
+    with os.scandir(image_dir) as entries:
+        return {entry.name for entry in entries if entry.name.lower().endswith(IMG_FILES) and entry.is_file()}
+
+
+def stat_image_files(image_dir: str) -> dict[str, tuple[int, int]]:
+    """ Image files of image_dir with their size and mtime, to tell when a file being copied in is complete. """
+    with os.scandir(image_dir) as entries:
+        return {entry.name: (stat.st_size, stat.st_mtime_ns) for entry in entries
+                if entry.name.lower().endswith(IMG_FILES) and entry.is_file() and (stat := entry.stat())}
+
+
+def collect_new_pairs(new_files: set[str], pending: dict[str, str]) -> list[tuple[str, str]]:
+    """ Match newly seen image files into pairs. Files still waiting for their twin are kept in pending. """
+    pairs = []
+    for name in sorted(new_files):
+        name_no_ext = os.path.splitext(name)[0]
+        if not name_no_ext.endswith(("_1", "_2")):
+            continue
+
+        base_img_name = name_no_ext[:-2]
+        if (twin := pending.pop(base_img_name, None)) is None:
+            pending[base_img_name] = name
+        else:
+            img0, img1 = sorted((twin, name))
+            pairs.append((img0, img1))
+
+    return sorted(pairs)
+
+
 def generate_rainbow_colors(n_points: int) -> list[str]:
     # Define the start and end hues in the HSV color space
     start_hue = 0.0  # Red (0 degrees in HSV)
@@ -81,18 +132,51 @@ def generate_rainbow_colors(n_points: int) -> list[str]:
     return hex_colors
 
 
-def generate_image_pyramid(image: Image, scales: tuple[float, ...]) -> tuple[ImageTk.PhotoImage, ...]:
-    pyramid = []
-    for scale in scales:  # TODO might be worth doing with cv2?
-        # Calculate the new size
-        new_width = int(image.width * scale)
-        new_height = int(image.height * scale)
+def scaled_size(size: tuple[int, int], scale: float) -> tuple[int, int]:
+    width, height = size
+    return int(width * scale), int(height * scale)
+
+
+def open_page(path: str, page: int = 0) -> Image:
+    """ Every image is opened here, in the UI and in worker processes, so that they all accept large scans. """
+    from PIL import Image
+
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    image = Image.open(path)
+    if page:
+        image.seek(page)
+    return image
+
+
+def open_overviews(path: str) -> list[tuple[float, Image]]:
+    """
+    Open the image and, for multi-resolution TIFFs, each embedded overview page as its own lazily decoded image.
+    Returns (scale, image) pairs, full resolution first and coarsest last.
+    """
+    source = open_page(path)
+    overviews = [(1., source)]
+    if source.format != "TIFF" or getattr(source, "n_frames", 1) < 2:
+        return overviews
+
+    base_w, base_h = source.size
+    for page in range(1, source.n_frames):
+        source.seek(page)
+        page_w, page_h = source.size
+        if page_w < base_w and abs(page_w / base_w - page_h / base_h) < 0.01:  # a reduced copy, not another image
+            overviews.append((page_w / base_w, open_page(path, page)))
+    source.seek(0)
+
+    return sorted(overviews, key=lambda overview: -overview[0])
 
-        # Resize the image and append to the pyramid
-        resized_image = image.resize((new_width, new_height), Image.Resampling.BILINEAR)
-        pyramid.append(ImageTk.PhotoImage(resized_image))
 
-    return tuple(pyramid)
+def pick_overview(overviews: list[tuple[float, Image]], scale: float) -> tuple[Image, float]:
+    """ Return the coarsest overview that still has at least scale pixels per original pixel, and its scale. """
+    for overview_scale, image in reversed(overviews):
+        if overview_scale >= scale:
+            return image, overview_scale
+
+    overview_scale, image = overviews[0]
+    return image, overview_scale
 
 
 def put_image_on_canvas(canvas: Canvas, image: ImageFile, coords: tuple[float, float] = (0, 0)):
@@ -101,7 +185,152 @@ def put_image_on_canvas(canvas: Canvas, image: ImageFile, coords: tuple[float, f
     x, y = coords
     canvas.image = image
     canvas.create_image(x, y, anchor=tk.NW, image=canvas.image, tags="image")
-    canvas.config(scrollregion=(0, 0, canvas.image.width(), canvas.image.height()))
+    canvas.config(scrollregion=(0, 0, *canvas.image_size))
+
+
+def image_origin(canvas: Canvas) -> tuple[float, float]:
+    """ Return the canvas position of the current zoom level's top-left corner. """
+    x, y = canvas.coords("image")
+    offset_x, offset_y = canvas.image_offset
+    return x - offset_x, y - offset_y
+
+
+def get_visible_region(canvas: Canvas, origin: tuple[float, float],
+                       margin: float = 0) -> tuple[int, int, int, int]:
+    """ Return the part of the current zoom level that is visible on the canvas, grown by margin canvas sizes. """
+    full_w, full_h = canvas.image_size
+    view_w, view_h = int(canvas.cget("width")), int(canvas.cget("height"))
+    margin_x, margin_y = int(view_w * margin), int(view_h * margin)
+    origin_x, origin_y = origin
+
+    x0 = min(max(0, int(-origin_x) - margin_x), full_w - 1)
+    y0 = min(max(0, int(-origin_y) - margin_y), full_h - 1)
+    x1 = max(min(full_w, int(-origin_x) + view_w + margin_x + 1), x0 + 1)
+    y1 = max(min(full_h, int(-origin_y) + view_h + margin_y + 1), y0 + 1)
+    return x0, y0, x1, y1
+
+
+def resample_region(image: Image, image_scale: float, scale: float, region: tuple[int, int, int, int],
+                    resample: str) -> Image:
+    """ Resample the given region of the zoom level at scale from an image with image_scale pixels per original. """
+    from PIL import Image
+
+    x0, y0, x1, y1 = region
+    factor = image_scale / scale
+    box = (x0 * factor, y0 * factor, min(image.width, x1 * factor), min(image.height, y1 * factor))
+    return image.resize((x1 - x0, y1 - y0), Image.Resampling[resample], box=box)
+
+
+decoded_pages: OrderedDict[tuple[str, float, tuple[int, int] | None], Image] = OrderedDict()  # see decode_region
+
+
+def decode_region(path: str, scale: float, region: tuple[int, int, int, int], resample: str,
+                  is_stale: Callable[[], bool] | None = None) -> Image | None:
+    """
+    Render a region of the zoom level at scale from the original file, decoding no more than that level needs:
+    the closest TIFF overview page, reduced further by a JPEG draft. For the refinement thread only: the pages it
+    decoded last are kept for the next stops of a pan or zoom, and a job gone stale before it started returns None.
+    """
+    if is_stale is not None and is_stale():
+        return None
+
+    overviews = open_overviews(path)
+    source_w = overviews[0][1].width
+    image, image_scale = pick_overview(overviews, scale)
+    draft_size = scaled_size(image.size, scale / image_scale) if scale < image_scale else None
+    key = (path, image_scale, draft_size)
+    try:
+        if key in decoded_pages:
+            decoded_pages.move_to_end(key)
+        else:
+            if draft_size is not None:
+                image.draft(None, draft_size)
+            image.load()
+            decoded_pages[key] = image
+            while len(decoded_pages) > REFINE_CACHE_SIZE:
+                _, evicted = decoded_pages.popitem(last=False)
+                evicted.close()
+    finally:
+        for _, overview in overviews:
+            if overview is not decoded_pages.get(key):
+                overview.close()
+
+    page = decoded_pages[key]
+    return resample_region(page, page.width / source_w, scale, region, resample)
+
+
+def forget_decoded_pages():
+    """ Drop the pages decode_region keeps, once their pair is off the canvases. Run it on the refinement thread. """
+    while decoded_pages:
+        _, page = decoded_pages.popitem()
+        page.close()
+
+
+def get_refine_job(canvas: Canvas, region: tuple[int, int, int, int]) -> tuple:
+    """ The function and arguments that render region of the current zoom level with the fine filter. """
+    scale = IMG_SCALES[canvas.scale_idx]
+    if canvas.source_scale < 1 and scale > canvas.source_scale:
+        generation = canvas.refine_generation
+        return decode_region, canvas.path, scale, region, RESAMPLE_FINE, \
+            lambda: canvas.refine_generation != generation
+    else:
+        return resample_region, canvas.working, canvas.source_scale, scale, region, RESAMPLE_FINE
+
+
+def get_start_zoom_idx(canvas: Canvas) -> int:
+    """ Neutral zoom, or in working-resolution mode the largest zoom level the working image holds in full. """
+    if canvas.source_scale >= 1:
+        return NEUTRAL_ZOOM_IDX
+
+    fitting = [idx for idx, scale in enumerate(IMG_SCALES) if scale <= canvas.source_scale]
+    return fitting[-1] if fitting else 0
+
+
+def render_region(canvas: Canvas, origin: tuple[float, float]):
+    """
+    Render only the visible part of the current zoom level (plus a margin for panning) from the working image.
+    Levels beyond it come out coarse here, until the idle refinement decodes them from the file, see get_refine_job.
+    """
+    from PIL import ImageTk
+
+    x0, y0, x1, y1 = get_visible_region(canvas, origin, margin=0.5)
+    region = resample_region(canvas.working, canvas.source_scale, IMG_SCALES[canvas.scale_idx], (x0, y0, x1, y1),
+                             RESAMPLE_FAST)
+
+    origin_x, origin_y = origin
+    canvas.image_offset = (x0, y0)
+    put_image_on_canvas(canvas, ImageTk.PhotoImage(region), (origin_x + x0, origin_y + y0))
+
+
+def refresh_region(canvas: Canvas):
+    """ Re-render an on-demand zoom level if panning uncovered parts of the canvas it does not cover. """
+    if canvas.scaled_images[canvas.scale_idx] is not None:
+        return
+
+    origin = image_origin(canvas)
+    x0, y0, x1, y1 = get_visible_region(canvas, origin)
+    offset_x, offset_y = canvas.image_offset
+    if not (offset_x <= x0 and offset_y <= y0 and
+            x1 <= offset_x + canvas.image.width() and y1 <= offset_y + canvas.image.height()):
+        render_region(canvas, origin)
+
+
+def put_refined_on_canvas(canvas: Canvas, image: ImageTk.PhotoImage, coords: tuple[float, float]):
+    """ Overlay a high-quality rendering of part of the current zoom level, between the image and the points. """
+    canvas.delete("refined")
+    canvas.refined = image
+    canvas.create_image(*coords, anchor=tk.NW, image=canvas.refined, tags="refined")
+    canvas.tag_raise("refined", "image")
+
+
+def show_zoom_level(canvas: Canvas, origin: tuple[float, float]):
+    """ Display the canvas' current zoom level with its top-left corner at origin. """
+    canvas.image_size = scaled_size(canvas.source_size, IMG_SCALES[canvas.scale_idx])
+    if (image := canvas.scaled_images[canvas.scale_idx]) is not None:
+        canvas.image_offset = (0, 0)
+        put_image_on_canvas(canvas, image, origin)
+    else:
+        render_region(canvas, origin)
 
 
 def get_canvas_position(cursor_x: int | float, cursor_y: int | float, canvas) -> tuple[int, int]:
@@ -131,13 +360,12 @@ def get_centered_oval_bbox(center_xy: tuple[float, float],
 
 def apply_image_scaling(canvas: Canvas, event_point: tuple[float, float]):
     canvas.zoom_scale = IMG_SCALES[canvas.scale_idx]
-    old_x, old_y = canvas.coords("image")
-    new_image = canvas.scaled_images[canvas.scale_idx]
-    new_w, new_h = new_image.width(), new_image.height()
+    old_x, old_y = image_origin(canvas)
+    new_w, new_h = scaled_size(canvas.source_size, canvas.zoom_scale)
     event_x, event_y = event_point
 
     # Get all relevant parameters
-    old_w, old_h = canvas.image.width(), canvas.image.height()
+    old_w, old_h = canvas.image_size
     old_cx, old_cy = old_w / 2, old_h / 2
     ratio_w = new_w / old_w
     ratio_h = new_h / old_h
@@ -160,7 +388,7 @@ def apply_image_scaling(canvas: Canvas, event_point: tuple[float, float]):
     new_x = old_x + dx
     new_y = old_y + dy
 
-    put_image_on_canvas(canvas, new_image, (new_x, new_y))
+    show_zoom_level(canvas, (new_x, new_y))
 
 
 def reset_canvases(*, canvas0: Canvas, canvas1: Canvas, points: list[tuple[tuple[int, int], tuple[int, int]]]) -> None:
@@ -168,6 +396,8 @@ def reset_canvases(*, canvas0: Canvas, canvas1: Canvas, points: list[tuple[tuple
     canvas1.points = []
     canvas0.temp_point = None
     canvas1.temp_point = None
+    canvas0.suggested = False
+    canvas1.suggested = False
     for p0, p1 in points:
         canvas0.points.append(p0)
         canvas1.points.append(p1)
@@ -179,14 +409,14 @@ def reset_canvases(*, canvas0: Canvas, canvas1: Canvas, points: list[tuple[tuple
 def in_canvas_coords(point: tuple[int | float, int | float], canvas: Canvas) -> tuple[float, float]:
     """ Return the given image point in its canvas' coordinates. """
     x, y = point
-    img_tl_x, img_tl_y = canvas.coords("image")
+    img_tl_x, img_tl_y = image_origin(canvas)
     return (x * canvas.zoom_scale + img_tl_x), (y * canvas.zoom_scale + img_tl_y)
 
 
 def in_image_coords(x: int | float, y: int | float, canvas: Canvas) -> tuple[float, float]:
     """ Return the given canvas point normalized to image coordinates, if inside the image. Else returns (-1, -1). """
-    img_tl_x, img_tl_y = canvas.coords("image")
-    w, h = canvas.image.width(), canvas.image.height()
+    img_tl_x, img_tl_y = image_origin(canvas)
+    w, h = canvas.image_size
     x -= img_tl_x
     y -= img_tl_y
 